@@ -1,10 +1,13 @@
-import hashlib, asyncio
-from sqlalchemy import Column, String, Text, select
+import hashlib, time, json
+from collections import OrderedDict
+from sqlalchemy import Column, String, Text, Integer, select, delete, or_, inspect, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.exc import IntegrityError
-import os
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+import os, logging
+from metrics import timed
 from dotenv import load_dotenv
 load_dotenv()
 
@@ -15,33 +18,256 @@ class QAEntry(Base):
     question_hash = Column(String, primary_key=True)
     question = Column(Text, nullable=False)
     answer = Column(Text, nullable=False)
+    # JSON lists of the document content hashes and subjects whose chunks were used as context
+    content_hashes = Column(Text, nullable=False, default="[]")
+    subjects = Column(Text, nullable=False, default="[]")
+    generation = Column(Integer, nullable=False, default=0)
+
+class CorpusGeneration(Base):
+    # Each subject row holds the global generation of the subject's latest ingest, so it compares against QAEntry.generation
+    __tablename__ = "corpus_generations"
+    subject = Column(String, primary_key=True)
+    generation = Column(Integer, nullable=False, default=0)
+
+# Row in corpus_generations that counts every ingest regardless of subject
+GLOBAL_GENERATION = "*"
 
 DATABASE_URL = os.environ.get("DATABASE_URL",os.environ.get("DATABASE_URL_DEV"))
+# SQLite caps bound parameters per statement, so bulk lookups and upserts are split into chunks
+CACHE_BATCH_SIZE = int(os.environ.get("CACHE_BATCH_SIZE", 500))
+
+MEMORY_CACHE_SIZE = int(os.environ.get("MEMORY_CACHE_SIZE", 2048))
+MEMORY_CACHE_TTL = float(os.environ.get("MEMORY_CACHE_TTL", 3600))
+# invalidate_subject only clears the memory tier of the worker that ingested, so every worker re-reads
+# corpus_generations at most this often and drops memory entries older than their subjects
+GENERATION_REFRESH_SECONDS = float(os.environ.get("GENERATION_REFRESH_SECONDS", 5))
 
 engine = create_async_engine(DATABASE_URL, echo=False, future=True)
 AsyncSessionLocal = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
 
+class MemoryCache:
+    """Bounded LRU tier with per-entry TTL that sits in front of the SQLite QA cache."""
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: str):
+        item = self.entries.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            del self.entries[key]
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key: str, value):
+        if self.max_size <= 0:
+            return
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, keys=None):
+        if keys is None:
+            self.entries.clear()
+            return
+        for key in keys:
+            self.entries.pop(key, None)
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self.entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations
+        }
+
+MEMORY_CACHE = MemoryCache(MEMORY_CACHE_SIZE, MEMORY_CACHE_TTL)
+
+# Async callbacks given the question hashes invalidate_subject dropped, for stores keyed by them like the semantic cache
+INVALIDATION_HANDLERS = []
+
+def register_invalidation_handler(func):
+    INVALIDATION_HANDLERS.append(func)
+    return func
+
+GENERATION_SNAPSHOT = {"generations": {}, "read_at": None}
+
+def entry_subjects(entry) -> set:
+    return set(json.loads(entry.subjects or "[]"))
+
 async def init_db():
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(migrate_qa_entries)
+        await conn.run_sync(rekey_qa_entries)
+
+def migrate_qa_entries(conn):
+    # create_all doesn't alter existing tables, so databases from before provenance tracking get the columns added here
+    existing = {c["name"] for c in inspect(conn).get_columns(QAEntry.__tablename__)}
+    for name, ddl in (
+        ("content_hashes", "TEXT NOT NULL DEFAULT '[]'"),
+        ("subjects", "TEXT NOT NULL DEFAULT '[]'"),
+        ("generation", "INTEGER NOT NULL DEFAULT 0"),
+    ):
+        if name not in existing:
+            logging.info(f"Adding column {name} to {QAEntry.__tablename__}")
+            conn.execute(text(f"ALTER TABLE {QAEntry.__tablename__} ADD COLUMN {name} {ddl}"))
+
+# Bumped whenever normalize_question changes, so rows keyed by the previous normalization are rekeyed once
+QUESTION_KEY_VERSION = 1
+
+def rekey_qa_entries(conn):
+    if conn.execute(text("PRAGMA user_version")).scalar() >= QUESTION_KEY_VERSION:
+        return
+    rows = conn.execute(select(QAEntry.question_hash, QAEntry.question)).all()
+    moved = 0
+    for old_hash, question in rows:
+        new_hash = question_key(question)
+        if new_hash == old_hash:
+            continue
+        # An older row might already hold the new key; the one being moved is then a duplicate
+        if conn.execute(select(QAEntry.question_hash).filter_by(question_hash=new_hash)).first():
+            conn.execute(delete(QAEntry).filter_by(question_hash=old_hash))
+        else:
+            conn.execute(QAEntry.__table__.update().where(QAEntry.question_hash == old_hash).values(question_hash=new_hash))
+        moved += 1
+    logging.info(f"Rekeyed {moved} cached answers to question key version {QUESTION_KEY_VERSION}")
+    conn.execute(text(f"PRAGMA user_version = {QUESTION_KEY_VERSION}"))
+
+async def get_generation(subject: str = GLOBAL_GENERATION) -> int:
+    async with AsyncSessionLocal() as session:
+        row = await session.get(CorpusGeneration, subject)
+        return row.generation if row else 0
+
+async def get_generations(subjects) -> dict[str, int]:
+    keys = {GLOBAL_GENERATION, *subjects}
+    async with AsyncSessionLocal() as session:
+        rows = await session.execute(select(CorpusGeneration).where(CorpusGeneration.subject.in_(keys)))
+        return {row.subject: row.generation for row in rows.scalars()}
+
+async def recent_generations() -> dict[str, int]:
+    read_at = GENERATION_SNAPSHOT["read_at"]
+    if read_at is None or time.monotonic() - read_at >= GENERATION_REFRESH_SECONDS:
+        async with AsyncSessionLocal() as session:
+            rows = await session.scalars(select(CorpusGeneration))
+            GENERATION_SNAPSHOT["generations"] = {row.subject: row.generation for row in rows}
+        GENERATION_SNAPSHOT["read_at"] = time.monotonic()
+    return GENERATION_SNAPSHOT["generations"]
+
+async def bump_generation(subject: str) -> int:
+    async with AsyncSessionLocal() as session:
+        stmt = sqlite_insert(CorpusGeneration).values(subject=GLOBAL_GENERATION, generation=1)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[CorpusGeneration.subject],
+            set_={"generation": CorpusGeneration.generation + 1}
+        )
+        await session.execute(stmt)
+        generation = (await session.get(CorpusGeneration, GLOBAL_GENERATION)).generation
+        stmt = sqlite_insert(CorpusGeneration).values(subject=subject, generation=generation)
+        stmt = stmt.on_conflict_do_update(index_elements=[CorpusGeneration.subject], set_={"generation": generation})
+        await session.execute(stmt)
+        await session.commit()
+    GENERATION_SNAPSHOT["read_at"] = None
+    logging.info(f"Corpus generation bumped to {generation} after ingesting into {subject}")
+    await invalidate_subject(subject)
+    return generation
+
+async def invalidate_subject(subject: str) -> int:
+    """Drops cached answers built from the subject's documents, plus answers that found no context at all."""
+    stale = or_(
+        QAEntry.subjects.contains(json.dumps(subject), autoescape=True),
+        QAEntry.subjects == "[]"
+    )
+    async with AsyncSessionLocal() as session:
+        result = await session.execute(delete(QAEntry).where(stale).returning(QAEntry.question_hash))
+        question_hashes = list(result.scalars())
+        await session.commit()
+    MEMORY_CACHE.invalidate([
+        key for key, (_, entry) in MEMORY_CACHE.entries.items()
+        if not entry_subjects(entry) or subject in entry_subjects(entry)
+    ])
+    for handler in INVALIDATION_HANDLERS:
+        try:
+            await handler(question_hashes)
+        except Exception as e:
+            logging.error(f"Invalidation handler {handler.__name__} failed for subject {subject}: {e}")
+    logging.info(f"Invalidated {len(question_hashes)} cached answers for subject {subject}")
+    return len(question_hashes)
+
+def is_stale(subjects: str, generation: int, generations: dict[str, int]) -> bool:
+    """True if the answer's subjects, or the corpus for answers without context, were ingested into after its generation."""
+    subjects = json.loads(subjects or "[]") or [GLOBAL_GENERATION]
+    return any(generations.get(subject, 0) > generation for subject in subjects)
 
 def hash_text(text: str) -> str:
     return hashlib.sha256(text.encode()).hexdigest()
 
+def normalize_question(question: str) -> str:
+    """Folds case, whitespace and trailing ?.! only, so "C++?" and "C?" or "2+2" and "2-2" stay distinct."""
+    return " ".join(question.lower().split()).rstrip("?.! ")
+
+def question_key(question: str) -> str:
+    return hash_text(normalize_question(question))
+
 async def get_answer(question_hash: str):
+    return (await get_answers([question_hash])).get(question_hash)
+
+async def memory_answers(question_hashes) -> dict[str, QAEntry]:
+    found = {}
+    for q_hash in question_hashes:
+        entry = MEMORY_CACHE.get(q_hash)
+        if entry:
+            found[q_hash] = entry
+    if not found:
+        return found
+    generations = await recent_generations()
+    stale = [q_hash for q_hash, entry in found.items() if is_stale(entry.subjects, entry.generation, generations)]
+    MEMORY_CACHE.invalidate(stale)
+    return {q_hash: entry for q_hash, entry in found.items() if q_hash not in stale}
+
+async def get_answers(question_hashes: list[str]) -> dict[str, QAEntry]:
+    unique_hashes = list(dict.fromkeys(question_hashes))
+    found = await memory_answers(unique_hashes)
+    unique_hashes = [q_hash for q_hash in unique_hashes if q_hash not in found]
+    if not unique_hashes:
+        return found
     async with AsyncSessionLocal() as session:
-        stmt = select(QAEntry).filter_by(question_hash=question_hash)
-        result = await session.execute(stmt)
-        response =  result.scalars().first()
-        return response
+        for start in range(0, len(unique_hashes), CACHE_BATCH_SIZE):
+            batch = unique_hashes[start:start + CACHE_BATCH_SIZE]
+            stmt = select(QAEntry).where(QAEntry.question_hash.in_(batch))
+            result = await session.execute(stmt)
+            for entry in result.scalars():
+                found[entry.question_hash] = entry
+                MEMORY_CACHE.put(entry.question_hash, entry)
+    return found
 
 async def add_qa_entry(question: str, answer: str):
-    question_hash = hash_text(question)
+    question_hash = question_key(question)
     async with AsyncSessionLocal() as session:
         entry = QAEntry(
             question_hash=question_hash,
             question=question,
-            answer=answer
+            answer=answer,
+            content_hashes="[]",
+            subjects="[]",
+            generation=await get_generation()
         )
         session.add(entry)
         try:
@@ -49,34 +275,90 @@ async def add_qa_entry(question: str, answer: str):
         except IntegrityError:
             await session.rollback()
             return None
+        MEMORY_CACHE.put(question_hash, entry)
         return entry
 
+async def add_qa_entries(pairs: list[tuple[str, str]], sources: list[dict] = None, generation: int = None) -> int:
+    """Upserts (question, answer) pairs; sources holds the matching {"content_hashes", "subjects"} provenance.
+
+    generation is the corpus generation read before the answers' context was retrieved.
+    """
+    sources = sources or [None] * len(pairs)
+    if generation is None:
+        generation = await get_generation()
+    rows = {}
+    for (question, answer), source in zip(pairs, sources):
+        source = source or {}
+        question_hash = question_key(question)
+        rows[question_hash] = {
+            "question_hash": question_hash,
+            "question": question,
+            "answer": answer,
+            "content_hashes": json.dumps(sorted(source.get("content_hashes", []))),
+            "subjects": json.dumps(sorted(source.get("subjects", []))),
+            "generation": generation
+        }
+    rows = list(rows.values())
+    if not rows:
+        return 0
+    async with AsyncSessionLocal() as session:
+        for start in range(0, len(rows), CACHE_BATCH_SIZE):
+            stmt = sqlite_insert(QAEntry).values(rows[start:start + CACHE_BATCH_SIZE])
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[QAEntry.question_hash],
+                set_={
+                    "question": stmt.excluded.question,
+                    "answer": stmt.excluded.answer,
+                    "content_hashes": stmt.excluded.content_hashes,
+                    "subjects": stmt.excluded.subjects,
+                    "generation": stmt.excluded.generation
+                }
+            )
+            await session.execute(stmt)
+        await session.commit()
+        # bump_generation commits the new generation before invalidating, so an ingest that finished while these
+        # answers were generated either shows up here or deletes the rows itself afterwards
+        generations = await get_generations({subject for row in rows for subject in json.loads(row["subjects"])})
+        stale = [row["question_hash"] for row in rows if is_stale(row["subjects"], row["generation"], generations)]
+        for start in range(0, len(stale), CACHE_BATCH_SIZE):
+            await session.execute(delete(QAEntry).where(QAEntry.question_hash.in_(stale[start:start + CACHE_BATCH_SIZE])))
+        await session.commit()
+    if stale:
+        logging.info(f"Dropped {len(stale)} answers generated before their subjects were re-ingested")
+    rows = [row for row in rows if row["question_hash"] not in stale]
+    for row in rows:
+        MEMORY_CACHE.put(row["question_hash"], QAEntry(**row))
+    return len(rows)
+
 async def update_answer(document_hash: str, question_hash: str, new_answer: str):
     async with AsyncSessionLocal() as session:
-        stmt = select(QAEntry).filter_by(document_hash=document_hash, question_hash=question_hash)
+        stmt = select(QAEntry).filter_by(question_hash=question_hash)
+        if document_hash:
+            stmt = stmt.where(QAEntry.content_hashes.contains(json.dumps(document_hash), autoescape=True))
         result = await session.execute(stmt)
         entry = result.scalars().first()
         if entry:
             entry.answer = new_answer
+            entry.generation = await get_generation()
             await session.commit()
+            MEMORY_CACHE.put(question_hash, entry)
             return True
         return False
 
+@timed("cache_lookup")
 async def checkCache(questions) -> tuple[list,list]:
     answers = []
     unanswered = []
-    for i, q in enumerate(questions):
-        q_hash = hash_text(q)
-        print(f"\nQuestion {i+1}: {q}")
-        response = await get_answer(q_hash)
+    question_hashes = [question_key(q) for q in questions]
+    cached = await get_answers(question_hashes)
+    for i, (q, q_hash) in enumerate(zip(questions, question_hashes)):
+        response = cached.get(q_hash)
         if response:
-            print(f"Answer: {response.answer}")
-            print("-----------------------------------")
+            logging.info(f"Question {i+1} answered from cache: {q}")
             answers.append(response.answer)
             unanswered.append("Cached")
         else:
-            print("No answer in cache")
-            print("-----------------------------------")
+            logging.info(f"Question {i+1} not in cache: {q}")
             unanswered.append(q)
             answers.append(None)
             
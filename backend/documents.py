@@ -0,0 +1,80 @@
+import hashlib, re, time, uuid
+from sqlalchemy import Column, String, Text, Integer, Float, select, delete
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from cache import Base, AsyncSessionLocal
+
+def source_key(file_link: str) -> str:
+    """Identifies a file across versions: Moodle bumps the revision in /content/<n>/ when a resource is replaced."""
+    return re.sub(r"/content/\d+/", "/content/", file_link.split("?", 1)[0])
+
+def chunk_point_id(key: str, chunk_hash: str) -> str:
+    """Stable across re-ingestions, so an unchanged chunk of a refreshed file maps onto its existing point."""
+    return str(uuid.UUID(hex=hashlib.sha256(f"{key}\0{chunk_hash}".encode()).hexdigest()[:32]))
+
+class IngestedDocument(Base):
+    """Registry of documents whose chunks are in Qdrant, so dedup checks and listings never touch the vector store."""
+    __tablename__ = "ingested_documents"
+    content_hash = Column(String, primary_key=True)
+    subject = Column(String, nullable=False, index=True)
+    file_name = Column(Text, nullable=False, default="")
+    file_link = Column(Text, nullable=False, default="")
+    # The file link without its revision, shared by every version of the same LMS resource
+    source_key = Column(Text, nullable=False, default="", index=True)
+    chunk_count = Column(Integer, nullable=False, default=0)
+    ingested_at = Column(Float, nullable=False)
+
+    def to_dict(self) -> dict:
+        return {
+            "content_hash": self.content_hash,
+            "subject": self.subject,
+            "file_name": self.file_name,
+            "file_link": self.file_link,
+            "source_key": self.source_key,
+            "chunk_count": self.chunk_count,
+            "ingested_at": self.ingested_at
+        }
+
+async def get_document(content_hash: str):
+    async with AsyncSessionLocal() as session:
+        return await session.get(IngestedDocument, content_hash)
+
+async def add_document(content_hash: str, subject: str, file_name: str, file_link: str, chunk_count: int, source_key: str = None, ingested_at: float = None):
+    values = {
+        "content_hash": content_hash,
+        "subject": subject,
+        "file_name": file_name or "",
+        "file_link": file_link or "",
+        "source_key": source_key or file_link or "",
+        "chunk_count": chunk_count,
+        "ingested_at": ingested_at or time.time()
+    }
+    async with AsyncSessionLocal() as session:
+        stmt = sqlite_insert(IngestedDocument).values(**values)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[IngestedDocument.content_hash],
+            set_={key: value for key, value in values.items() if key != "content_hash"}
+        )
+        await session.execute(stmt)
+        await session.commit()
+
+async def list_documents(subject: str = None) -> list[IngestedDocument]:
+    stmt = select(IngestedDocument).order_by(IngestedDocument.ingested_at)
+    if subject:
+        stmt = stmt.where(IngestedDocument.subject == subject)
+    async with AsyncSessionLocal() as session:
+        return list(await session.scalars(stmt))
+
+async def remove_documents_for_source(source_key: str) -> int:
+    async with AsyncSessionLocal() as session:
+        result = await session.execute(delete(IngestedDocument).where(IngestedDocument.source_key == source_key))
+        await session.commit()
+    return result.rowcount
+
+async def remove_documents(subject: str, content_hash: str = None) -> int:
+    stmt = delete(IngestedDocument).where(IngestedDocument.subject == subject)
+    if content_hash:
+        stmt = stmt.where(IngestedDocument.content_hash == content_hash)
+    async with AsyncSessionLocal() as session:
+        result = await session.execute(stmt)
+        await session.commit()
+    return result.rowcount
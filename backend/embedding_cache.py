@@ -0,0 +1,140 @@
+import asyncio, hashlib, logging, os, time
+import numpy as np
+from sqlalchemy import Column, String, LargeBinary, Float, select, delete, func, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from cache import Base, AsyncSessionLocal, MemoryCache, CACHE_BATCH_SIZE
+from metrics import span
+from dotenv import load_dotenv
+load_dotenv()
+
+EMBEDDING_CACHE_ENABLED = os.environ.get("EMBEDDING_CACHE_ENABLED", "true").lower() == "true"
+# float16 halves the table at a precision loss well below what cosine ranking notices
+EMBEDDING_CACHE_DTYPE = np.dtype(os.environ.get("EMBEDDING_CACHE_DTYPE", "float16"))
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.environ.get("EMBEDDING_CACHE_MAX_ENTRIES", 200000))
+# Query embeddings only: repeated questions and sub-queries are served from here without touching SQLite
+EMBEDDING_MEMORY_CACHE = MemoryCache(
+    int(os.environ.get("EMBEDDING_MEMORY_CACHE_SIZE", 4096)),
+    float(os.environ.get("EMBEDDING_MEMORY_CACHE_TTL", 3600))
+)
+
+# Writes and recency updates happen off the request path; held here so the tasks aren't garbage collected
+PENDING_WRITES = set()
+# Counting rows for eviction is a table scan, so it only happens after this many new entries
+TRIM_INTERVAL = 1000
+inserted_since_trim = 0
+
+class CachedEmbedding(Base):
+    __tablename__ = "embeddings"
+    # sha256 of the model name and text, so switching models never serves stale vectors
+    key = Column(String, primary_key=True)
+    vector = Column(LargeBinary, nullable=False)
+    last_used = Column(Float, nullable=False, index=True)
+
+def embedding_key(model_name: str, text: str) -> str:
+    return hashlib.sha256(f"{model_name}\0{text}".encode()).hexdigest()
+
+def pack(vector) -> bytes:
+    return np.asarray(vector, dtype=EMBEDDING_CACHE_DTYPE).tobytes()
+
+def unpack(blob: bytes) -> list[float]:
+    return np.frombuffer(blob, dtype=EMBEDDING_CACHE_DTYPE).astype(np.float32).tolist()
+
+async def load_vectors(keys: list[str]) -> dict[str, list[float]]:
+    found = {}
+    async with AsyncSessionLocal() as session:
+        for start in range(0, len(keys), CACHE_BATCH_SIZE):
+            rows = await session.execute(
+                select(CachedEmbedding.key, CachedEmbedding.vector).where(CachedEmbedding.key.in_(keys[start:start + CACHE_BATCH_SIZE]))
+            )
+            found.update({key: unpack(blob) for key, blob in rows})
+    return found
+
+async def touch_vectors(keys: list[str]):
+    now = time.time()
+    async with AsyncSessionLocal() as session:
+        for start in range(0, len(keys), CACHE_BATCH_SIZE):
+            await session.execute(
+                update(CachedEmbedding).where(CachedEmbedding.key.in_(keys[start:start + CACHE_BATCH_SIZE])).values(last_used=now)
+            )
+        await session.commit()
+
+async def store_vectors(vectors: dict[str, list[float]]):
+    global inserted_since_trim
+    now = time.time()
+    items = list(vectors.items())
+    async with AsyncSessionLocal() as session:
+        for start in range(0, len(items), CACHE_BATCH_SIZE):
+            rows = [{"key": key, "vector": pack(vector), "last_used": now} for key, vector in items[start:start + CACHE_BATCH_SIZE]]
+            stmt = sqlite_insert(CachedEmbedding).values(rows)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[CachedEmbedding.key],
+                set_={"vector": stmt.excluded.vector, "last_used": stmt.excluded.last_used}
+            )
+            await session.execute(stmt)
+        await session.commit()
+    inserted_since_trim += len(items)
+    if inserted_since_trim >= TRIM_INTERVAL:
+        inserted_since_trim = 0
+        await trim()
+
+async def trim():
+    async with AsyncSessionLocal() as session:
+        excess = await session.scalar(select(func.count()).select_from(CachedEmbedding)) - EMBEDDING_CACHE_MAX_ENTRIES
+        if excess <= 0:
+            return
+        oldest = select(CachedEmbedding.key).order_by(CachedEmbedding.last_used).limit(excess)
+        await session.execute(delete(CachedEmbedding).where(CachedEmbedding.key.in_(oldest)))
+        await session.commit()
+    logging.info(f"Evicted {excess} least recently used cached embeddings")
+
+def write_behind(make_write, description: str):
+    async def write():
+        try:
+            await make_write()
+        except Exception as e:
+            logging.error(f"Failed to {description}: {e}")
+    task = asyncio.create_task(write())
+    PENDING_WRITES.add(task)
+    task.add_done_callback(PENDING_WRITES.discard)
+
+async def embed_with_cache(model_name: str, texts: list[str], embed_missing, persist: bool = True) -> list[list[float]]:
+    """Returns vectors for texts, calling the async embed_missing only for texts not embedded before.
+
+    Ingestion uses the SQLite tier; query-time callers pass persist=False and use only the in-memory tier, so a large
+    ingest never evicts hot query vectors.
+    """
+    if not EMBEDDING_CACHE_ENABLED or not texts:
+        return await embed_missing(texts) if texts else []
+
+    keys = [embedding_key(model_name, text) for text in texts]
+    vectors = {}
+    if not persist:
+        for key in dict.fromkeys(keys):
+            vector = EMBEDDING_MEMORY_CACHE.get(key)
+            if vector is not None:
+                vectors[key] = vector
+
+    stored = {}
+    with span("embedding_cache_lookup"):
+        try:
+            if persist:
+                stored = await load_vectors([key for key in dict.fromkeys(keys) if key not in vectors])
+        except Exception as e:
+            logging.error(f"Embedding cache lookup failed: {e}")
+    vectors.update(stored)
+    if stored:
+        write_behind(lambda: touch_vectors(list(stored)), "update cached embedding recency")
+
+    # Duplicate texts within the batch are embedded once
+    missing = {key: text for key, text in zip(keys, texts) if key not in vectors}
+    if missing:
+        embedded = dict(zip(missing, await embed_missing(list(missing.values()))))
+        vectors.update(embedded)
+        if persist:
+            write_behind(lambda: store_vectors(embedded), "store embeddings in the cache")
+    logging.info(f"Embedding cache served {len(texts) - len(missing)}/{len(texts)} texts")
+
+    if not persist:
+        for key in keys:
+            EMBEDDING_MEMORY_CACHE.put(key, vectors[key])
+    return [vectors[key] for key in keys]
@@ -0,0 +1,84 @@
+# Runs inside the CPU worker processes, so this module only imports what extraction itself needs
+from langchain.docstore.document import Document as LangchainDocument
+from docx import Document
+from pptx import Presentation
+import io, os, logging, magic, pymupdf, tempfile
+
+# Downloads too large to keep in memory are spooled here
+TEMP_DIR = os.environ.get("INGEST_TEMP_DIR") or tempfile.gettempdir()
+
+# MIME type -> function taking the document's bytes or spooled path and returning (text, metadata) pairs
+EXTRACTORS = {}
+
+def register_extractor(mime_type: str):
+    def decorator(func):
+        EXTRACTORS[mime_type] = func
+        return func
+    return decorator
+
+def open_source(source):
+    """python-docx and python-pptx take a path or a file object, so in-memory content is wrapped rather than written out."""
+    return source if isinstance(source, str) else io.BytesIO(source)
+
+@register_extractor('application/pdf')
+def extract_pdf(source):
+    pdf = pymupdf.open(source) if isinstance(source, str) else pymupdf.open(stream=source, filetype="pdf")
+    with pdf:
+        return [
+            (page.get_text(), {"page": page.number, "total_pages": pdf.page_count})
+            for page in pdf
+        ]
+
+@register_extractor('application/vnd.openxmlformats-officedocument.wordprocessingml.document')
+def extract_docx(source):
+    document = Document(open_source(source))
+    return [("\n".join(paragraph.text for paragraph in document.paragraphs), {})]
+
+@register_extractor('application/vnd.openxmlformats-officedocument.presentationml.presentation')
+def extract_pptx(source):
+    prs = Presentation(open_source(source))
+    full_text = []
+    for slide in prs.slides:
+        for shape in slide.shapes:
+            if hasattr(shape, "has_text_frame") and shape.has_text_frame:
+                full_text.append(shape.text)
+    return [("\n".join(full_text), {})]
+
+SUPPORTED_MIME_TYPES = set(EXTRACTORS)
+
+def sniff_mime_type(source) -> str:
+    """source is either the document's bytes or the path it was spooled to."""
+    if isinstance(source, str):
+        return magic.from_file(source, mime=True)
+    return magic.from_buffer(source, mime=True)
+
+def extract_document(source, mime_type, document_hash, subject, file_name, file_source):
+    logging.info("Attempting to load document")
+    extractor = EXTRACTORS.get(mime_type)
+    if extractor is None:
+        logging.error(f"Internal error: Unsupported MIME type {mime_type} passed the check.")
+        return False,"An internal error occurred"
+
+    try:
+        sections = extractor(source)
+    except Exception as e:
+        logging.error(f"Failed to extract {file_name} as {mime_type}: {e}")
+        return False, "An error occured"
+
+    docs = [
+        LangchainDocument(
+            page_content=text,
+            metadata={
+                **metadata,
+                "content_hash": document_hash,
+                "subject": subject,
+                "file_name": file_name,
+                "file_link": file_source
+            }
+        )
+        for text, metadata in sections
+    ]
+    if not docs:
+        logging.error("Document loading failed")
+        return False, "An error occured"
+    return True, docs
@@ -1,182 +1,355 @@
-from langchain_community.document_loaders import PyMuPDFLoader
-from langchain.docstore.document import Document as LangchainDocument
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_community.embeddings.fastembed import FastEmbedEmbeddings
 from langchain_qdrant import QdrantVectorStore
 from qdrant_client import QdrantClient
-from qdrant_client.http.models import Distance, VectorParams
-import hashlib, os, uuid, logging, requests, magic
-import lms_handling
-from docx import Document
-from pptx import Presentation
+from qdrant_client.http.models import PointStruct, Filter, FieldCondition, MatchValue, FilterSelector, PointIdsList, SetPayloadOperation, SetPayload
+import asyncio, hashlib, os, logging, httpx
+import lms_handling, cache, documents
+from documents import source_key, chunk_point_id
+from embedding_cache import embed_with_cache
+from qdrant_collections import ensure_collection, DOCUMENT_INDEXES
+from metrics import span
+from extraction import extract_document, sniff_mime_type, SUPPORTED_MIME_TYPES, TEMP_DIR
+from workers import run_cpu, run_io, embed_texts, EMBEDDING_MODEL_NAME
 from dotenv import load_dotenv
 load_dotenv()
 
 QDRANT_COLLECTION_NAME = "LMS"
 QDRANT_URL = os.environ.get("QDRANT_URL")
-EMBEDDING_MODEL = FastEmbedEmbeddings(model_name="BAAI/bge-small-en-v1.5")
+# gRPC skips JSON encoding of vectors on upserts; the client falls back to REST where gRPC isn't supported
+QDRANT_PREFER_GRPC = os.environ.get("QDRANT_PREFER_GRPC", "true").lower() == "true"
+QDRANT_GRPC_PORT = int(os.environ.get("QDRANT_GRPC_PORT", 6334))
+EMBEDDING_MODEL = FastEmbedEmbeddings(model_name=EMBEDDING_MODEL_NAME)
 
-try:
-    client = QdrantClient(
-        url=QDRANT_URL
-    )
-    QDRANT_INSTANCE = QdrantVectorStore(
-        client=client,
-        collection_name=QDRANT_COLLECTION_NAME,
-        embedding=EMBEDDING_MODEL,
-    )
-except:
-    client = QdrantClient(
-        url=QDRANT_URL
-    )
-    client.create_collection(
-        collection_name=QDRANT_COLLECTION_NAME,
-        vectors_config=VectorParams(size=384, distance=Distance.COSINE),
-    )
-    QDRANT_INSTANCE = QdrantVectorStore(
-        client=client,
-        collection_name=QDRANT_COLLECTION_NAME,
-        embedding=EMBEDDING_MODEL,
-    )
+# Chunks per embedding call and per upsert request
+INGEST_BATCH_SIZE = int(os.environ.get("INGEST_BATCH_SIZE", 64))
+UPSERT_CONCURRENCY = int(os.environ.get("UPSERT_CONCURRENCY", 4))
+UPSERT_MAX_RETRIES = int(os.environ.get("UPSERT_MAX_RETRIES", 3))
+# How long to wait for wait=False upserts to become visible before re-sending the missing points
+UPSERT_CONSISTENCY_TIMEOUT = float(os.environ.get("UPSERT_CONSISTENCY_TIMEOUT", 30))
+upsert_limiter = asyncio.Semaphore(UPSERT_CONCURRENCY)
 
-SUPPORTED_MIME_TYPES = {
-    'application/pdf',
-    'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
-    'application/vnd.openxmlformats-officedocument.presentationml.presentation'
-}
+client = QdrantClient(
+    url=QDRANT_URL,
+    prefer_grpc=QDRANT_PREFER_GRPC,
+    grpc_port=QDRANT_GRPC_PORT
+)
+ensure_collection(client, QDRANT_COLLECTION_NAME, DOCUMENT_INDEXES)
+QDRANT_INSTANCE = QdrantVectorStore(
+    client=client,
+    collection_name=QDRANT_COLLECTION_NAME,
+    embedding=EMBEDDING_MODEL,
+)
 
+# Downloads are refused past this size, and spooled to TEMP_DIR once they outgrow the in-memory limit
+INGEST_MAX_BYTES = int(os.environ.get("INGEST_MAX_BYTES", 100 * 1024 * 1024))
+INGEST_MEMORY_BYTES = int(os.environ.get("INGEST_MEMORY_BYTES", 8 * 1024 * 1024))
 
-async def ingestData(subject: str, file_name:str, file_source:str, session_id: str) -> str:
-    cookies = lms_handling.get_session_cookies(session_id)
-    if not cookies:
+# Content hashes currently being ingested, so identical files uploaded concurrently are only ingested once
+INGESTING_HASHES = set()
+
+async def ingestData(subject: str, file_name:str, file_source:str, session_id: str, progress=None) -> tuple[bool, str]:
+    """Returns (ok, message); ok is False whenever the file did not end up in the collection."""
+    progress = progress or (lambda stage: None)
+    session = await lms_handling.get_client(session_id)
+    if not session:
         logging.error("Upload requested without a valid LMS session")
-        return "Unauthorized session"
+        return False, "Unauthorized session"
 
-    session = lms_handling.build_session(cookies)
     try:
         logging.info(f"Getting file: {file_name} from {file_source}")
-        response = session.get(file_source)
-        response.raise_for_status()
-        document_content = response.content
-        document_hash = calculate_pdf_hash(document_content)
-        logging.info(f"Calculated PDF hash: {document_hash}")
-    except requests.RequestException as e:
+        progress("download")
+        with span("download"):
+            download = await lms_handling.lms_download(
+                session, file_source, INGEST_MAX_BYTES, INGEST_MEMORY_BYTES, TEMP_DIR
+            )
+        document_hash = download.sha256
+        logging.info(f"Downloaded {download.size} bytes, content hash: {document_hash}")
+    except lms_handling.DocumentTooLarge as e:
+        logging.warning(f"Refusing to ingest {file_name}: {e}")
+        return False, "File too large"
+    except httpx.HTTPError as e:
         logging.error(f"Failed to download file: {e}")
-        return "Source invalid"
+        return False, "Source invalid"
+
+    try:
+        if document_hash in INGESTING_HASHES:
+            logging.info("The same content is already being ingested. Skipping ingestion")
+            return True, "Already being ingested"
+        INGESTING_HASHES.add(document_hash)
+        try:
+            return await ingest_content(subject, file_name, file_source, download.source, document_hash, progress)
+        finally:
+            INGESTING_HASHES.discard(document_hash)
+    finally:
+        download.close()
 
+async def ingest_content(subject, file_name, file_source, document_source, document_hash, progress) -> tuple[bool, str]:
+    """document_source is the content itself for small files, or the path of the spooled download."""
     logging.info("Checking if the content already exists")
+    progress("dedup_check")
     if await check_for_existing_document(document_hash):
-        return "Already exists in database"
+        return True, "Already exists in database"
 
-    check, docs = extract_document(document_content, document_hash, subject, file_name, file_source)
+    with span("mime_sniff"):
+        mime_type = sniff_mime_type(document_source)
+    if mime_type not in SUPPORTED_MIME_TYPES:
+        logging.warning(f"Unsupported file type detected: {mime_type}. Skipping ingestion.")
+        return False, "Unsupported file type"
+
+    progress("extraction")
+    with span("extraction"):
+        check, docs = await run_cpu(extract_document, document_source, mime_type, document_hash, subject, file_name, file_source)
     if check:
-        text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=300)
-        split_docs = text_splitter.split_documents(documents=docs)
+        progress("chunking")
+        with span("chunking"):
+            text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=300)
+            split_docs = text_splitter.split_documents(documents=docs)
         logging.info("Document chunking complete")
     else:
         logging.info("Document extraction failed")
-        return docs
+        return False, docs
 
     try:
-        await QDRANT_INSTANCE.aadd_documents(split_docs)
+        progress("diff")
+        with span("chunk_diff"):
+            key = source_key(file_source)
+            chunks = {}
+            for doc in split_docs:
+                doc.metadata["source_key"] = key
+                doc.metadata["chunk_hash"] = hashlib.sha256(doc.page_content.encode()).hexdigest()
+                chunks.setdefault(chunk_point_id(key, doc.metadata["chunk_hash"]), doc)
+            existing = await existing_point_ids(key, file_source)
+            new_ids = [point_id for point_id in chunks if point_id not in existing]
+            kept_ids = [point_id for point_id in chunks if point_id in existing]
+            removed_ids = list(existing - set(chunks))
+        logging.info(f"{file_name}: {len(new_ids)} new, {len(kept_ids)} unchanged and {len(removed_ids)} removed chunks")
+
+        progress("embedding")
+        await embed_and_upsert(new_ids, [chunks[point_id] for point_id in new_ids], progress)
+        await refresh_chunk_metadata({point_id: chunks[point_id].metadata for point_id in kept_ids})
+        await delete_chunks(removed_ids)
         logging.info("Chunks loaded in DB")
-        return "File loaded successfully"
+        # The previous version of this file is superseded rather than kept as a duplicate
+        await documents.remove_documents_for_source(key)
+        await documents.add_document(document_hash, subject, file_name, file_source, len(chunks), key)
+        await cache.bump_generation(subject)
+        return True, "File loaded successfully"
     except Exception as e:
-        logging.info(f"Chunk loading failed: {e}")
-        return "An error occured"
+        logging.error(f"Chunk loading failed: {e}")
+        return False, "An error occured"
 
-def calculate_pdf_hash(pdf_content: bytes) -> str:
-    return hashlib.sha256(pdf_content).hexdigest()
+async def embed_chunks(split_docs) -> list[list[float]]:
+    async def embed_missing(texts):
+        return await run_cpu(embed_texts, texts)
 
-def extract_document(document_content, document_hash, subject, file_name, file_source):
-    logging.info("Attempting to load document")
-    mime_type = magic.from_buffer(document_content, mime=True)
-    temp_file_path=""
-    if mime_type not in SUPPORTED_MIME_TYPES:
-        logging.warning(f"Unsupported file type detected: {mime_type}. Skipping ingestion.")
-        return False,"Unsupported file type"
-
-    if mime_type == 'application/pdf':
-        file_extension = ".pdf"
-        temp_file_path = create_temp_file(file_extension,document_content)
-        loader = PyMuPDFLoader(temp_file_path)       
-        docs = loader.load()  
-        for doc in docs:
-            doc.metadata["content_hash"] = document_hash
-            doc.metadata["subject"] = subject
-            doc.metadata["file_name"] = file_name
-            doc.metadata["file_link"] = file_source
-    elif mime_type == 'application/vnd.openxmlformats-officedocument.wordprocessingml.document':
-        file_extension = ".docx"
-        temp_file_path = create_temp_file(file_extension,document_content)
-        document = Document(temp_file_path)
-        full_text = []
-        for paragraph in document.paragraphs:
-            full_text.append(paragraph.text)
-        text_content = "/n".join(full_text)
-        doc_metadata = {
-            "content_hash": document_hash,
-            "subject": subject,
-            "file_name": file_name,
-            "file_link": file_source
-        }
-        docs = [LangchainDocument(
-        page_content=text_content,
-        metadata=doc_metadata
-        )]
-    elif mime_type == 'application/vnd.openxmlformats-officedocument.presentationml.presentation':
-        file_extension = ".pptx"
-        temp_file_path = create_temp_file(file_extension,document_content)
-        prs = Presentation(temp_file_path)
-        full_text = []
-        for slide in prs.slides:
-            for shape in slide.shapes:
-                if hasattr(shape, "has_text_frame") and shape.has_text_frame:
-                    full_text.append(shape.text)
-        doc_metadata = {
-            "content_hash": document_hash,
-            "subject": subject,
-            "file_name": file_name,
-            "file_link": file_source
-        }
-        docs = [Document(page_content="\n".join(full_text), metadata=doc_metadata)]
-    else:
-        logging.error(f"Internal error: Unsupported MIME type {mime_type} passed the check.")
-        return False,"An internal error occurred"
+    with span("embedding"):
+        return await embed_with_cache(EMBEDDING_MODEL_NAME, [doc.page_content for doc in split_docs], embed_missing)
 
-    os.remove(temp_file_path)
-    
-    if not docs:
-        logging.error("Document loading failed")
-        return False, "An error occured"
-    return True, docs
+async def embed_queries(texts: list[str]) -> list[list[float]]:
+    """Query-time embedding in the event loop process.
 
-def create_temp_file(file_extension, document_content):
-    temp_file_path = f"temp_{uuid.uuid4()}{file_extension}"
-    with open(temp_file_path, "wb") as f:
-        f.write(document_content)
-    return temp_file_path
+    Questions are kept in the in-memory tier only: they rarely match chunk text, and persisting one-off
+    questions would evict chunk vectors from the table while adding SQLite writes to every query.
+    """
+    return await embed_with_cache(EMBEDDING_MODEL_NAME, texts, EMBEDDING_MODEL.aembed_documents, persist=False)
+
+async def existing_point_ids(key: str, file_link: str) -> set[str]:
+    # Chunks ingested before source keys existed are only findable by their exact link
+    version_filter = Filter(should=[
+        FieldCondition(key="metadata.source_key", match=MatchValue(value=key)),
+        FieldCondition(key="metadata.file_link", match=MatchValue(value=file_link))
+    ])
+    point_ids = set()
+    offset = None
+    try:
+        while True:
+            points, offset = await run_io(
+                client.scroll,
+                collection_name=QDRANT_COLLECTION_NAME,
+                scroll_filter=version_filter,
+                limit=1000,
+                offset=offset,
+                with_payload=False,
+                with_vectors=False
+            )
+            point_ids.update(str(point.id) for point in points)
+            if offset is None:
+                return point_ids
+    except Exception as e:
+        logging.info(f"Could not list existing chunks of {file_link}, treating it as new: {e}")
+        return set()
+
+async def embed_and_upsert(point_ids, split_docs, progress):
+    """Embeds in INGEST_BATCH_SIZE batches, embedding batch N+1 while batch N uploads, then checks every point landed."""
+    batches = [
+        (point_ids[start:start + INGEST_BATCH_SIZE], split_docs[start:start + INGEST_BATCH_SIZE])
+        for start in range(0, len(point_ids), INGEST_BATCH_SIZE)
+    ]
+    if not batches:
+        return
+    uploads = []
+    next_vectors = asyncio.create_task(embed_chunks(batches[0][1]))
+    try:
+        for i, (batch_ids, batch_docs) in enumerate(batches):
+            vectors = await next_vectors
+            if i + 1 < len(batches):
+                next_vectors = asyncio.create_task(embed_chunks(batches[i + 1][1]))
+            uploads.append(asyncio.create_task(upsert_chunks(batch_ids, batch_docs, vectors)))
+        progress("upsert")
+        await asyncio.gather(*uploads)
+    except BaseException:
+        next_vectors.cancel()
+        for upload in uploads:
+            upload.cancel()
+        raise
+    with span("qdrant_consistency_check"):
+        await ensure_points_stored(batches)
+
+async def upsert_chunks(point_ids, split_docs, vectors, wait=False):
+    if not point_ids:
+        return
+    points = [
+        PointStruct(
+            id=point_id,
+            vector=vector,
+            payload={
+                QDRANT_INSTANCE.content_payload_key: doc.page_content,
+                QDRANT_INSTANCE.metadata_payload_key: doc.metadata
+            }
+        )
+        for point_id, doc, vector in zip(point_ids, split_docs, vectors)
+    ]
+    async with upsert_limiter:
+        for attempt in range(UPSERT_MAX_RETRIES + 1):
+            try:
+                with span("qdrant_upsert"):
+                    await run_io(client.upsert, collection_name=QDRANT_COLLECTION_NAME, points=points, wait=wait)
+                return
+            except Exception as e:
+                if attempt == UPSERT_MAX_RETRIES:
+                    raise
+                logging.warning(f"Upserting a batch of {len(points)} chunks failed ({e}), retrying")
+                await asyncio.sleep(0.5 * 2 ** attempt)
+
+async def missing_point_ids(point_ids) -> list:
+    stored = await run_io(
+        client.retrieve,
+        collection_name=QDRANT_COLLECTION_NAME,
+        ids=point_ids,
+        with_payload=False,
+        with_vectors=False
+    )
+    stored_ids = {str(point.id) for point in stored}
+    return [point_id for point_id in point_ids if point_id not in stored_ids]
+
+async def ensure_points_stored(batches):
+    """wait=False upserts are only queued when acknowledged, so batches whose points don't show up are re-sent with wait=True."""
+    deadline = asyncio.get_running_loop().time() + UPSERT_CONSISTENCY_TIMEOUT
+    pending = list(batches)
+    while pending:
+        still_pending = []
+        for batch_ids, batch_docs in pending:
+            if await missing_point_ids(batch_ids):
+                still_pending.append((batch_ids, batch_docs))
+        pending = still_pending
+        if not pending or asyncio.get_running_loop().time() > deadline:
+            break
+        await asyncio.sleep(0.5)
+
+    for batch_ids, batch_docs in pending:
+        missing = set(await missing_point_ids(batch_ids))
+        logging.warning(f"{len(missing)} upserted chunks never became visible, re-sending them")
+        resend = [(point_id, doc) for point_id, doc in zip(batch_ids, batch_docs) if point_id in missing]
+        await upsert_chunks(
+            [point_id for point_id, _ in resend],
+            [doc for _, doc in resend],
+            await embed_chunks([doc for _, doc in resend]),
+            wait=True
+        )
+
+async def refresh_chunk_metadata(metadata_by_id: dict):
+    """Unchanged chunks keep their vectors but take the new version's content hash, name and page numbers."""
+    if not metadata_by_id:
+        return
+    operations = [
+        SetPayloadOperation(set_payload=SetPayload(
+            payload={QDRANT_INSTANCE.metadata_payload_key: metadata}, points=[point_id]
+        ))
+        for point_id, metadata in metadata_by_id.items()
+    ]
+    with span("qdrant_set_payload"):
+        await run_io(client.batch_update_points, collection_name=QDRANT_COLLECTION_NAME, update_operations=operations)
+
+async def delete_chunks(point_ids):
+    if not point_ids:
+        return
+    with span("qdrant_delete"):
+        await run_io(
+            client.delete,
+            collection_name=QDRANT_COLLECTION_NAME,
+            points_selector=PointIdsList(points=point_ids)
+        )
+
+def field_filter(**fields) -> Filter:
+    return Filter(must=[
+        FieldCondition(key=f"metadata.{key}", match=MatchValue(value=value)) for key, value in fields.items()
+    ])
 
 async def check_for_existing_document(document_hash: str) -> bool:
+    if await documents.get_document(document_hash):
+        logging.info("Document with the same content hash already exists. Skipping ingestion")
+        return True
+
+    # Documents ingested before the registry existed are only in Qdrant; found ones are registered on the way
     try:
-        qdrant_filter = {
-            "must": [
-                {
-                    "key": "metadata.content_hash",
-                    "match": {
-                        "value": document_hash
-                    }
-                }
-            ]
-        }
-        search_results = await QDRANT_INSTANCE.asimilarity_search("dummy query", k=1, filter=qdrant_filter)
-        if search_results:
-            logging.info("Document with the same source and content hash already exists. Skipping ingestion")
-            return True
-        else:
+        points, _ = await run_io(
+            client.scroll,
+            collection_name=QDRANT_COLLECTION_NAME,
+            scroll_filter=field_filter(content_hash=document_hash),
+            limit=1,
+            with_payload=True,
+            with_vectors=False
+        )
+        if not points:
             logging.info("Document not found. Proceeding with ingestion")
             return False
-
+        chunk_count = await run_io(
+            client.count,
+            collection_name=QDRANT_COLLECTION_NAME,
+            count_filter=field_filter(content_hash=document_hash),
+            exact=True
+        )
     except Exception as e:
         logging.info(f"Collection '{QDRANT_COLLECTION_NAME}' does not exist yet. Assuming no duplicates: {e}")
         return False
+
+    metadata = points[0].payload.get(QDRANT_INSTANCE.metadata_payload_key) or {}
+    file_link = metadata.get("file_link") or ""
+    # Chunks from before source keys existed don't carry one, so it's derived the same way ingestion does
+    await documents.add_document(
+        document_hash, metadata.get("subject", ""), metadata.get("file_name"), file_link, chunk_count.count,
+        metadata.get("source_key") or source_key(file_link)
+    )
+    logging.info("Document with the same content hash already exists in Qdrant. Skipping ingestion")
+    return True
+
+async def listDocuments(subject: str = None) -> list[dict]:
+    return [document.to_dict() for document in await documents.list_documents(subject)]
+
+async def deleteDocuments(subject: str, content_hash: str = None) -> int:
+    """Removes a subject's documents, or just one of them, from Qdrant and the registry."""
+    fields = {"subject": subject}
+    if content_hash:
+        fields["content_hash"] = content_hash
+    with span("qdrant_delete"):
+        await run_io(
+            client.delete,
+            collection_name=QDRANT_COLLECTION_NAME,
+            points_selector=FilterSelector(filter=field_filter(**fields))
+        )
+    removed = await documents.remove_documents(subject, content_hash)
+    logging.info(f"Deleted {removed} documents from {subject}")
+    # Cached answers may quote the deleted chunks
+    await cache.bump_generation(subject)
+    return removed
@@ -0,0 +1,131 @@
+import asyncio, logging, os, time
+from collections import OrderedDict
+from uuid import uuid4
+from ingestion import ingestData
+from metrics import request_id
+from dotenv import load_dotenv
+load_dotenv()
+
+INGEST_WORKERS = int(os.environ.get("INGEST_WORKERS", 2))
+# Finished jobs kept around for /jobs lookups before the oldest are forgotten
+JOB_HISTORY_SIZE = int(os.environ.get("JOB_HISTORY_SIZE", 500))
+
+class IngestionJob:
+    def __init__(self, subject: str, file_name: str, file_link: str, session_id: str):
+        self.id = uuid4().hex
+        self.subject = subject
+        self.file_name = file_name
+        self.file_link = file_link
+        self.session_id = session_id
+        self.request_id = request_id.get()
+        self.status = "queued"
+        self.stage = None
+        self.stages = OrderedDict()
+        self.result = None
+        self.created_at = time.time()
+        self.updated_at = self.created_at
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("completed", "failed")
+
+    def progress(self, stage: str):
+        now = time.time()
+        if self.stage:
+            self.stages[self.stage]["status"] = "done"
+            self.stages[self.stage]["seconds"] = now - self.stages[self.stage]["started_at"]
+        self.stage = stage
+        self.stages[stage] = {"status": "running", "started_at": now}
+        self.updated_at = now
+
+    def finish(self, status: str, result: str):
+        now = time.time()
+        if self.stage:
+            current = self.stages[self.stage]
+            current["status"] = "done" if status == "completed" else "failed"
+            current["seconds"] = now - current["started_at"]
+        self.stage = None
+        self.status = status
+        self.result = result
+        self.updated_at = now
+
+    def to_dict(self) -> dict:
+        return {
+            "job_id": self.id,
+            "subject": self.subject,
+            "file_name": self.file_name,
+            "file_link": self.file_link,
+            "status": self.status,
+            "stage": self.stage,
+            "stages": self.stages,
+            "result": self.result,
+            "created_at": self.created_at,
+            "updated_at": self.updated_at
+        }
+
+class JobQueue:
+    """Runs ingestion jobs on a fixed pool of workers, collapsing duplicate uploads of the same file link."""
+
+    def __init__(self, workers: int):
+        self.worker_count = workers
+        self.queue = asyncio.Queue()
+        self.jobs = OrderedDict()
+        self.active_links = {}
+        self.workers = []
+
+    def start(self):
+        self.workers = [asyncio.create_task(self.work()) for _ in range(self.worker_count)]
+        logging.info(f"Started {self.worker_count} ingestion workers")
+
+    async def stop(self):
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+    def submit(self, subject: str, file_name: str, file_link: str, session_id: str) -> IngestionJob:
+        existing = self.active_links.get(file_link)
+        if existing:
+            logging.info(f"{file_link} is already queued as job {existing.id}")
+            return existing
+        job = IngestionJob(subject, file_name, file_link, session_id)
+        self.jobs[job.id] = job
+        self.active_links[file_link] = job
+        self.queue.put_nowait(job)
+        self.trim()
+        logging.info(f"Queued ingestion job {job.id} for {file_name}")
+        return job
+
+    def get(self, job_id: str):
+        return self.jobs.get(job_id)
+
+    def trim(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.finished]
+        for job_id in finished[:max(0, len(finished) - JOB_HISTORY_SIZE)]:
+            del self.jobs[job_id]
+
+    async def work(self):
+        while True:
+            job = await self.queue.get()
+            request_id.set(job.request_id)
+            job.status = "running"
+            try:
+                ok, result = await ingestData(job.subject, job.file_name, job.file_link, job.session_id, job.progress)
+                job.finish("completed" if ok else "failed", result)
+            except Exception as e:
+                logging.error(f"Ingestion job {job.id} failed: {e}")
+                job.finish("failed", "An error occured")
+            finally:
+                self.active_links.pop(job.file_link, None)
+                self.queue.task_done()
+            logging.info(f"Ingestion job {job.id} {job.status}: {job.result}")
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self.queue.qsize(),
+            "active": len(self.active_links),
+            "workers": len(self.workers)
+        }
+
+# Job state is per process: with several uvicorn workers, /jobs/{id} only finds jobs submitted to the same worker
+JOB_QUEUE = JobQueue(INGEST_WORKERS)
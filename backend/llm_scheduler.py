@@ -0,0 +1,148 @@
+import asyncio, heapq, itertools, logging, os, random, time
+from dotenv import load_dotenv
+load_dotenv()
+
+LLM_RATE_LIMIT = float(os.environ.get("LLM_RATE_LIMIT", 10))
+LLM_BURST = int(os.environ.get("LLM_BURST", 10))
+LLM_MAX_IN_FLIGHT = int(os.environ.get("LLM_MAX_IN_FLIGHT", 16))
+LLM_MAX_RETRIES = int(os.environ.get("LLM_MAX_RETRIES", 3))
+LLM_RETRY_BASE_DELAY = float(os.environ.get("LLM_RETRY_BASE_DELAY", 0.5))
+LLM_RETRY_BUDGET = float(os.environ.get("LLM_RETRY_BUDGET", 20))
+LLM_RETRY_BUDGET_RATIO = float(os.environ.get("LLM_RETRY_BUDGET_RATIO", 0.1))
+
+# Lower values are dispatched first
+PRIORITY_ANSWER = 0
+PRIORITY_SUB_QUERY = 1
+
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+RETRYABLE_MARKERS = ("429", "500", "502", "503", "504", "RESOURCE_EXHAUSTED", "UNAVAILABLE", "DEADLINE_EXCEEDED")
+
+def is_retryable(error: Exception) -> bool:
+    code = getattr(error, "code", None) or getattr(error, "status_code", None)
+    if isinstance(code, int):
+        return code in RETRYABLE_STATUS_CODES
+    message = str(error)
+    return any(marker in message for marker in RETRYABLE_MARKERS)
+
+class LLMScheduler:
+    """Dispatches LLM calls by priority under a token-bucket rate limit and a max-in-flight cap.
+
+    Retryable failures are retried with jittered exponential backoff while the shared retry budget lasts.
+    The budget refills by a fraction of a retry per successful call, so a provider outage can't multiply load.
+    """
+
+    def __init__(self, rate: float, burst: int, max_in_flight: int, max_retries: int,
+                 base_delay: float, retry_budget: float, retry_budget_ratio: float):
+        self.rate = rate
+        self.burst = burst
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_retry_budget = retry_budget
+        self.retry_budget = retry_budget
+        self.retry_budget_ratio = retry_budget_ratio
+        self.tokens = float(burst)
+        self.refilled_at = time.monotonic()
+        self.waiters = []
+        self.sequence = itertools.count()
+        self.in_flight = 0
+        self.timer = None
+        self.calls = 0
+        self.failures = 0
+        self.retries = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def refill(self):
+        now = time.monotonic()
+        if self.rate > 0:
+            self.tokens = min(self.burst, self.tokens + (now - self.refilled_at) * self.rate)
+        self.refilled_at = now
+
+    def dispatch(self):
+        self.refill()
+        while self.waiters and self.in_flight < self.max_in_flight:
+            _, _, waiter = self.waiters[0]
+            if waiter.done():
+                heapq.heappop(self.waiters)
+                continue
+            if self.rate > 0 and self.tokens < 1:
+                if self.timer is None:
+                    delay = (1 - self.tokens) / self.rate
+                    self.timer = asyncio.get_running_loop().call_later(delay, self.on_timer)
+                return
+            heapq.heappop(self.waiters)
+            if self.rate > 0:
+                self.tokens -= 1
+            self.in_flight += 1
+            waiter.set_result(None)
+
+    def on_timer(self):
+        self.timer = None
+        self.dispatch()
+
+    async def acquire(self, priority: int):
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (priority, next(self.sequence), waiter))
+        self.dispatch()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            # A slot granted right before cancellation has to be handed back
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        self.in_flight -= 1
+        self.dispatch()
+
+    async def run(self, priority: int, make_call, can_retry=None):
+        """Awaits make_call() once a slot is free; can_retry() may veto retries, e.g. after partial streaming."""
+        attempt = 0
+        while True:
+            queued_at = time.monotonic()
+            await self.acquire(priority)
+            waited = time.monotonic() - queued_at
+            self.total_wait += waited
+            self.max_wait = max(self.max_wait, waited)
+            self.calls += 1
+            try:
+                result = await make_call()
+                self.retry_budget = min(self.max_retry_budget, self.retry_budget + self.retry_budget_ratio)
+                return result
+            except Exception as e:
+                self.failures += 1
+                if (not is_retryable(e) or attempt >= self.max_retries or self.retry_budget < 1
+                        or (can_retry and not can_retry())):
+                    raise
+                self.retry_budget -= 1
+                self.retries += 1
+                attempt += 1
+                delay = self.base_delay * (2 ** (attempt - 1)) * random.uniform(0.5, 1.5)
+                logging.warning(f"LLM call failed ({e}), retry {attempt}/{self.max_retries} in {delay:.2f}s")
+            finally:
+                self.release()
+            await asyncio.sleep(delay)
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": sum(1 for _, _, waiter in self.waiters if not waiter.done()),
+            "in_flight": self.in_flight,
+            "calls": self.calls,
+            "failures": self.failures,
+            "retries": self.retries,
+            "retry_budget": round(self.retry_budget, 2),
+            "avg_wait_seconds": self.total_wait / self.calls if self.calls else 0.0,
+            "max_wait_seconds": self.max_wait
+        }
+
+LLM_SCHEDULER = LLMScheduler(
+    rate=LLM_RATE_LIMIT,
+    burst=LLM_BURST,
+    max_in_flight=LLM_MAX_IN_FLIGHT,
+    max_retries=LLM_MAX_RETRIES,
+    base_delay=LLM_RETRY_BASE_DELAY,
+    retry_budget=LLM_RETRY_BUDGET,
+    retry_budget_ratio=LLM_RETRY_BUDGET_RATIO
+)
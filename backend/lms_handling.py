@@ -1,32 +1,186 @@
-import requests, re
-from bs4 import BeautifulSoup
+import httpx, os, asyncio, time, hashlib, tempfile
+from urllib.parse import urlsplit
+from cache import MemoryCache
+from sessions import SESSION_STORE
+from lms_parsing import parse_subjects, parse_logout_link, parse_activities, parse_resource_link
 import logging
 from fastapi import status
 from uuid import uuid4
+from dotenv import load_dotenv
+load_dotenv()
 
-LMS_SESSIONS = {}
+# One pooled keep-alive client per LMS session in this worker, reused across requests
+LMS_CLIENTS = {}
 
+LMS_TIMEOUT = float(os.environ.get("LMS_TIMEOUT", 20))
+LMS_MAX_RETRIES = int(os.environ.get("LMS_MAX_RETRIES", 2))
+LMS_MAX_CONNECTIONS = int(os.environ.get("LMS_MAX_CONNECTIONS", 10))
+# Activity pages resolved at once per LMS host, across every session
+LMS_HOST_CONCURRENCY = int(os.environ.get("LMS_HOST_CONCURRENCY", 6))
+HOST_LIMITERS = {}
+# Resolved file URLs per (session, activity link)
+RESOLVED_FILES = MemoryCache(
+    int(os.environ.get("RESOLVED_FILES_CACHE_SIZE", 10000)),
+    float(os.environ.get("RESOLVED_FILES_CACHE_TTL", 1800))
+)
+# Parsed subject listings per (user, subject URL); within SUBJECT_FRESH_SECONDS they're served without asking the LMS
+SUBJECT_FILES = MemoryCache(
+    int(os.environ.get("SUBJECT_FILES_CACHE_SIZE", 5000)),
+    float(os.environ.get("SUBJECT_FILES_CACHE_TTL", 86400))
+)
+SUBJECT_FRESH_SECONDS = float(os.environ.get("SUBJECT_FRESH_SECONDS", 300))
+try:
+    import h2
+    LMS_HTTP2 = True
+except ImportError:
+    LMS_HTTP2 = False
 
-def get_session(session_id: str):
-    if not session_id:
-        return None
-    return LMS_SESSIONS.get(session_id)
+
+async def get_session(session_id: str):
+    return await SESSION_STORE.get(session_id)
 
 
-def get_session_cookies(session_id: str):
-    session = get_session(session_id)
+async def get_session_cookies(session_id: str):
+    session = await get_session(session_id)
     if not session:
         return None
     return session["cookies"]
 
 
-def build_session(cookies=None):
-    session = requests.Session()
-    if cookies:
-        requests.utils.add_dict_to_cookiejar(session.cookies, cookies)
-    return session
+def build_client(cookies=None) -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        cookies=cookies,
+        http2=LMS_HTTP2,
+        follow_redirects=True,
+        timeout=httpx.Timeout(LMS_TIMEOUT),
+        limits=httpx.Limits(max_connections=LMS_MAX_CONNECTIONS, max_keepalive_connections=LMS_MAX_CONNECTIONS)
+    )
+
+async def get_client(session_id: str):
+    cookies = await get_session_cookies(session_id)
+    if not cookies:
+        await close_client(session_id)
+        return None
+    client = LMS_CLIENTS.get(session_id)
+    if client is None or client.is_closed:
+        client = build_client(cookies)
+        LMS_CLIENTS[session_id] = client
+    return client
+
+async def close_client(session_id: str):
+    client = LMS_CLIENTS.pop(session_id, None)
+    if client:
+        await client.aclose()
+
+async def close_clients():
+    for session_id in list(LMS_CLIENTS):
+        await close_client(session_id)
+
+async def prune_clients():
+    """Closes this worker's clients for sessions that expired or were logged out elsewhere."""
+    for session_id in list(LMS_CLIENTS):
+        if not await get_session(session_id):
+            await close_client(session_id)
+
+def cookie_dict(client: httpx.AsyncClient) -> dict:
+    return {cookie.name: cookie.value for cookie in client.cookies.jar}
+
+async def lms_get(client: httpx.AsyncClient, url: str, headers=None) -> httpx.Response:
+    """GETs with bounded exponential-backoff retries on transport errors and 5xx responses."""
+    for attempt in range(LMS_MAX_RETRIES + 1):
+        try:
+            response = await client.get(url, headers=headers)
+            if response.status_code < 500 or attempt == LMS_MAX_RETRIES:
+                return response
+            logging.warning(f"LMS returned {response.status_code} for {url}, retrying")
+        except httpx.TransportError as e:
+            if attempt == LMS_MAX_RETRIES:
+                raise
+            logging.warning(f"LMS request to {url} failed ({e}), retrying")
+        await asyncio.sleep(0.5 * 2 ** attempt)
+
+class DocumentTooLarge(Exception):
+    pass
+
+class LMSSessionExpired(httpx.HTTPError):
+    """The LMS answered a page request by redirecting to another page, typically the login form."""
+
+class Download:
+    """A downloaded file held in memory, or spooled to disk once it outgrows the memory limit."""
+
+    def __init__(self, memory_bytes: int, temp_dir: str):
+        self.memory_bytes = memory_bytes
+        self.temp_dir = temp_dir
+        self.buffer = bytearray()
+        self.file = None
+        self.path = None
+        self.size = 0
+        self.hasher = hashlib.sha256()
+
+    def write(self, chunk: bytes):
+        self.hasher.update(chunk)
+        self.size += len(chunk)
+        if self.file is None and self.size > self.memory_bytes:
+            self.file = tempfile.NamedTemporaryFile(dir=self.temp_dir, prefix="download_", delete=False)
+            self.path = self.file.name
+            self.file.write(self.buffer)
+            self.buffer = bytearray()
+        if self.file is not None:
+            self.file.write(chunk)
+        else:
+            self.buffer.extend(chunk)
+
+    def finish(self):
+        if self.file is not None:
+            self.file.close()
+
+    @property
+    def sha256(self) -> str:
+        return self.hasher.hexdigest()
+
+    @property
+    def source(self):
+        """The path of the spooled file, or the bytes of a small one."""
+        return self.path or bytes(self.buffer)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+        self.buffer = bytearray()
 
-def logIn(username:str, password:str):
+async def lms_download(client: httpx.AsyncClient, url: str, max_bytes: int, memory_bytes: int, temp_dir: str) -> Download:
+    """Streams a file, hashing each chunk as it arrives, and raises DocumentTooLarge as soon as max_bytes is passed."""
+    for attempt in range(LMS_MAX_RETRIES + 1):
+        download = Download(memory_bytes, temp_dir)
+        try:
+            async with client.stream("GET", url) as response:
+                if response.status_code >= 500 and attempt < LMS_MAX_RETRIES:
+                    logging.warning(f"LMS returned {response.status_code} for {url}, retrying")
+                    download.close()
+                    await asyncio.sleep(0.5 * 2 ** attempt)
+                    continue
+                response.raise_for_status()
+                if int(response.headers.get("Content-Length") or 0) > max_bytes:
+                    raise DocumentTooLarge(f"{url} is {response.headers['Content-Length']} bytes")
+                async for chunk in response.aiter_bytes():
+                    download.write(chunk)
+                    if download.size > max_bytes:
+                        raise DocumentTooLarge(f"{url} is over {max_bytes} bytes")
+            download.finish()
+            return download
+        except httpx.TransportError as e:
+            download.close()
+            if attempt == LMS_MAX_RETRIES:
+                raise
+            logging.warning(f"LMS download of {url} failed ({e}), retrying")
+            await asyncio.sleep(0.5 * 2 ** attempt)
+        except BaseException:
+            download.close()
+            raise
+
+async def logIn(username:str, password:str):
     login_url = "https://mydy.dypatil.edu/rait/login/index.php"
     form_data = {
         "uname_static": username,
@@ -35,43 +189,51 @@ def logIn(username:str, password:str):
         "password": password
     }
     
-    with requests.Session() as s:
+    s = build_client()
+    try:
         logging.info(f"Getting Initial Cookie from {login_url}")
-        get_response = s.get(login_url)
-        logging.info(f"Request Status: {get_response.status_code}, Cookie received: {s.cookies.get_dict()}")
+        get_response = await lms_get(s, login_url)
+        logging.info(f"Request Status: {get_response.status_code}, Cookie received: {cookie_dict(s)}")
         logging.info(f"Sending login POST request to {login_url}")
-        post_response = s.post(login_url, data=form_data)
+        post_response = await s.post(login_url, data=form_data)
         if post_response.status_code == 200:
             logging.info(f"Request Status: {post_response.status_code}")
-            if "mydy.dypatil.edu/rait/my/" in post_response.url:
+            if "mydy.dypatil.edu/rait/my/" in str(post_response.url):
                 logging.info("Login Successful")
-                subjects,logout_url = extractLinks(s)
+                subjects,logout_url = await extractLinks(s)
                 session_id = str(uuid4())
-                LMS_SESSIONS[session_id] = {
-                    "cookies": s.cookies.get_dict(),
-                    "logout_url": logout_url
-                }
+                await SESSION_STORE.put(session_id, {
+                    "cookies": cookie_dict(s),
+                    "logout_url": logout_url,
+                    "username": username
+                })
+                LMS_CLIENTS[session_id] = s
                 return status.HTTP_200_OK, subjects, logout_url, session_id
             else:
                 logging.info("Login failed. Invalid credentials.")
+                await s.aclose()
                 return status.HTTP_401_UNAUTHORIZED, None, None, None
         else:
             logging.error(f"Login request failed with status code: {post_response.status_code}")
             logging.error("Response text: %s", post_response.text)
+            await s.aclose()
             return status.HTTP_503_SERVICE_UNAVAILABLE, None, None, None
+    except httpx.HTTPError as e:
+        logging.error(f"An error occurred while logging in: {e}")
+        await s.aclose()
+        return status.HTTP_503_SERVICE_UNAVAILABLE, None, None, None
     
-def extractLinks(s):
+async def extractLinks(s):
     dashboard_url="https://mydy.dypatil.edu/rait/my/"
     classes_url= "https://mydy.dypatil.edu/rait/blocks/academic_status/ajax.php?action=myclasses"
     try:
-        logging.info(f"Getting Dashboard Html from {dashboard_url}")
-        dashboard_response = s.get(dashboard_url)
+        logging.info(f"Getting Dashboard and Classes Html from {dashboard_url} and {classes_url}")
+        dashboard_response, classes_response = await asyncio.gather(lms_get(s, dashboard_url), lms_get(s, classes_url))
         dashboard_response.raise_for_status()
-        logging.info(f"Getting Classes Html from {classes_url}")
-        classes_response = s.get(classes_url)
         classes_response.raise_for_status()
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         logging.error(f"An error occured while extracting links: {e}")
+        return [], ""
 
     subjects = getSubjects(classes_response.text)
     logout_url = getLogoutLink(dashboard_response.text)
@@ -79,98 +241,155 @@ def extractLinks(s):
     return subjects,logout_url
 
 def getSubjects(classes_html):
-    soup = BeautifulSoup(classes_html, 'lxml')
-    subjects = []
-    subject_containers = soup.find_all('div', class_=lambda c: c and 'subjectcontainer' in [cls.strip(';') for cls in c.split()])
-    if not subject_containers:
-        logging.info("No subject containers found in the HTML.")
-        return []
-    for container in subject_containers:
-        subject_name_tag = container.find('h4', class_='cfullname')
-        launch_link_tag = container.find('a', class_='launchbutton')
-        
-        sub_content = container.find('div', class_='subcontent-container')
-        attendance_total = sub_content.find('span', class_='attendance-total')
-        if attendance_total:
-            attendance_info = attendance_total.text.strip()
-        else:
-            attendance_info= "---"
-
-        if subject_name_tag and launch_link_tag:
-            subject_name = subject_name_tag.text.strip()
-            subject_url = launch_link_tag.get('href').strip()
-            subject_data = {
-                "subject_name": subject_name,
-                "url": subject_url,
-                "attendance": attendance_info
-            }
-            subjects.append(subject_data)
-    return subjects
+    return [subject._asdict() for subject in parse_subjects(classes_html)]
 
 def getLogoutLink(dashboard_html):
-    logout_soup = BeautifulSoup(dashboard_html, 'lxml')
-    logout_link = logout_soup.find('a', href=lambda href: href and 'logout.php?sesskey=' in href)
-    if not logout_link:
+    logout_url = parse_logout_link(dashboard_html)
+    if not logout_url:
         logging.error("Could not find the logout link with a sesskey.")
         return ""
-    logout_url = logout_link['href']        
-    if not logout_url.startswith('http'):
-        logout_url = f"https://mydy.dypatil.edu{logout_url}"
     logging.info(f"Found logout URL: {logout_url}")
     return logout_url
 
-def logOut(session_id: str):
-    session = get_session(session_id)
+async def logOut(session_id: str):
+    session = await get_session(session_id)
     if not session:
         return status.HTTP_401_UNAUTHORIZED
 
-    s = build_session(session["cookies"])
+    s = await get_client(session_id)
     logout_url = session["logout_url"]
     try:
-        logout_response = s.get(logout_url)
+        logout_response = await lms_get(s, logout_url)
         logout_response.raise_for_status()
-        if "mydy.dypatil.edu" in logout_response.url:
-            del LMS_SESSIONS[session_id]
+        if "mydy.dypatil.edu" in str(logout_response.url):
+            await SESSION_STORE.delete(session_id)
+            await close_client(session_id)
             return status.HTTP_200_OK
         else:
             logging.error("Logout request sent, but the final URL was not the login page.")
             return status.HTTP_404_NOT_FOUND
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         logging.error(f"An error occurred while logging out: {e}")
         return status.HTTP_500_INTERNAL_SERVER_ERROR
     
-def fetchFiles(session_id: str, subject:str,subject_url: str):
-    cookies = get_session_cookies(session_id)
-    if not cookies:
+async def loadSubjectPage(s, session_id, subject, subject_url, refresh=False):
+    """Returns (cache key, cached files if the listing is unchanged, parsed activities otherwise, page validators)."""
+    session = await get_session(session_id) or {}
+    key = f"{session.get('username') or session_id}:{subject_url}"
+    cached = None if refresh else SUBJECT_FILES.get(key)
+    if cached and time.time() - cached["checked_at"] < SUBJECT_FRESH_SECONDS:
+        logging.info(f"Serving cached {subject} file list")
+        return key, cached["files"], None, None
+
+    headers = {}
+    if cached and cached["etag"]:
+        headers["If-None-Match"] = cached["etag"]
+    if cached and cached["last_modified"]:
+        headers["If-Modified-Since"] = cached["last_modified"]
+    logging.info(f"Getting {subject} html from {subject_url}")
+    subject_response = await lms_get(s, subject_url, headers=headers or None)
+    # Error pages and the login form the LMS redirects expired sessions to must never be cached as the listing
+    if subject_response.status_code != 304:
+        subject_response.raise_for_status()
+        if urlsplit(str(subject_response.url)).path != urlsplit(subject_url).path:
+            raise LMSSessionExpired(f"{subject_url} redirected to {subject_response.url}")
+    validators = {
+        "etag": subject_response.headers.get("ETag"),
+        "last_modified": subject_response.headers.get("Last-Modified"),
+        "page_hash": hashlib.sha256(subject_response.content).hexdigest(),
+        "checked_at": time.time()
+    }
+    # Moodle course pages rarely send validators, so an identical page body also counts as unchanged
+    if cached and (subject_response.status_code == 304 or validators["page_hash"] == cached["page_hash"]):
+        logging.info(f"{subject} page unchanged, reusing cached file list")
+        cached["checked_at"] = validators["checked_at"]
+        SUBJECT_FILES.put(key, cached)
+        return key, cached["files"], None, None
+    return key, None, parse_activities(subject_response.text), validators
+
+def storeSubjectFiles(key, files, validators):
+    SUBJECT_FILES.put(key, {**validators, "files": files})
+
+async def resolveActivity(s, session_id, subject, file_link, file_name, refresh=False):
+    key = f"{session_id}:{file_link}"
+    resolved = None if refresh else RESOLVED_FILES.get(key)
+    if resolved is None:
+        host = urlsplit(file_link).netloc
+        limiter = HOST_LIMITERS.setdefault(host, asyncio.Semaphore(LMS_HOST_CONCURRENCY))
+        async with limiter:
+            resolved = await getFile(file_link, s)
+        RESOLVED_FILES.put(key, resolved)
+    pdf_link, check = resolved
+    if not check:
+        return None
+    return {
+        "file_name": file_name,
+        "file_link": pdf_link,
+        "subject": subject
+    }
+
+async def fetchFiles(session_id: str, subject:str,subject_url: str, refresh: bool = False):
+    s = await get_client(session_id)
+    if not s:
         return status.HTTP_401_UNAUTHORIZED, None
 
-    s = build_session(cookies)
-    files = []
     try:
-        logging.info(f"Getting {subject} html from {subject_url}")
-        subject_response = s.get(subject_url)
-        subject_html=subject_response.text
-        subject_soup = BeautifulSoup(subject_html,"lxml")
-        file_instances = subject_soup.find_all('div',class_="activityinstance")
-        for f in file_instances:
-            file_link = f.find("a")["href"]
-            file_name = f.find("span",class_="instancename").contents[0]
-            pdf_link, check = getFile(file_link, s)
-            if check:
-                file = {
-                    "file_name": file_name,
-                    "file_link": pdf_link,
-                    "subject": subject
-                }
-                files.append(file)
+        key, files, activities, validators = await loadSubjectPage(s, session_id, subject, subject_url, refresh)
+        if files is not None:
+            return status.HTTP_200_OK,files
+        resolved = await asyncio.gather(*[
+            resolveActivity(s, session_id, subject, file_link, file_name, refresh) for file_link, file_name in activities
+        ])
+        files = [file for file in resolved if file]
+        storeSubjectFiles(key, files, validators)
         return status.HTTP_200_OK,files
+    except LMSSessionExpired as e:
+        logging.error(f"LMS session expired while fetching {subject}: {e}")
+        return status.HTTP_401_UNAUTHORIZED, None
     except:
         return status.HTTP_500_INTERNAL_SERVER_ERROR, None
 
-def getFile(file_link, s):
+async def streamFiles(session_id: str, subject:str,subject_url: str, refresh: bool = False):
+    """Yields each resolved file as soon as its activity page has been read, in completion order."""
+    s = await get_client(session_id)
+    if not s:
+        return
+    try:
+        key, files, activities, validators = await loadSubjectPage(s, session_id, subject, subject_url, refresh)
+    except httpx.HTTPError as e:
+        logging.error(f"Failed to get {subject} html: {e}")
+        return
+    if files is not None:
+        for file in files:
+            yield file
+        return
+
+    tasks = [
+        asyncio.create_task(resolveActivity(s, session_id, subject, file_link, file_name, refresh))
+        for file_link, file_name in activities
+    ]
+    files = []
+    complete = True
+    try:
+        for next_file in asyncio.as_completed(tasks):
+            try:
+                file = await next_file
+            except httpx.HTTPError as e:
+                logging.error(f"Failed to resolve an activity link: {e}")
+                complete = False
+                continue
+            if file:
+                files.append(file)
+                yield file
+    finally:
+        for task in tasks:
+            task.cancel()
+    # A listing with failed resolutions isn't cached, so the next request retries them
+    if complete:
+        storeSubjectFiles(key, files, validators)
+
+async def getFile(file_link, s):
     logging.info(f"Getting file from {file_link}")
-    pdf_response = s.get(file_link)
-    pdf_html = pdf_response.text
-    pattern = r'["\'](https?://[^\s"]+\.(?:pdf|docx|pptx))'
-    pdf_link = re.search(pattern, pdf_html)
-    return (pdf_link.group(1),True) if pdf_link else ("", False)
+    pdf_response = await lms_get(s, file_link)
+    pdf_link = parse_resource_link(pdf_response.text)
+    return (pdf_link,True) if pdf_link else ("", False)
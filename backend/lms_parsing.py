@@ -0,0 +1,80 @@
+import logging, re
+from typing import NamedTuple
+from lxml import etree, html
+
+LMS_BASE_URL = "https://mydy.dypatil.edu"
+
+class Subject(NamedTuple):
+    subject_name: str
+    url: str
+    attendance: str
+
+class Activity(NamedTuple):
+    file_link: str
+    file_name: str
+
+def has_class(name: str) -> str:
+    # Moodle sometimes writes class lists like "subjectcontainer; col", so ';' counts as a separator
+    return f"contains(concat(' ', translate(normalize-space(@class), ';', ' '), ' '), ' {name} ')"
+
+# Compiled once; each call walks the tree lxml already built in C instead of matching lambdas per tag
+SUBJECT_CONTAINERS = etree.XPath(f"//div[{has_class('subjectcontainer')}]")
+SUBJECT_NAME = etree.XPath(f"string(.//h4[{has_class('cfullname')}][1])")
+LAUNCH_LINK = etree.XPath(f"(.//a[{has_class('launchbutton')}]/@href)[1]")
+ATTENDANCE = etree.XPath(f".//div[{has_class('subcontent-container')}]//span[{has_class('attendance-total')}]")
+LOGOUT_LINK = etree.XPath("(//a[contains(@href, 'logout.php?sesskey=')]/@href)[1]")
+ACTIVITIES = etree.XPath(f"//div[{has_class('activityinstance')}]")
+ACTIVITY_LINK = etree.XPath("(.//a/@href)[1]")
+ACTIVITY_NAME = etree.XPath(f".//span[{has_class('instancename')}]")
+RESOURCE_LINK = re.compile(r'["\'](https?://[^\s"]+\.(?:pdf|docx|pptx))')
+
+def parse_page(page_html: str):
+    if not page_html or not page_html.strip():
+        return None
+    return html.fromstring(page_html)
+
+def parse_subjects(classes_html: str) -> list[Subject]:
+    tree = parse_page(classes_html)
+    containers = SUBJECT_CONTAINERS(tree) if tree is not None else []
+    if not containers:
+        logging.info("No subject containers found in the HTML.")
+        return []
+    subjects = []
+    for container in containers:
+        subject_name = SUBJECT_NAME(container).strip()
+        launch_link = LAUNCH_LINK(container)
+        if not subject_name or not launch_link:
+            continue
+        attendance = ATTENDANCE(container)
+        subjects.append(Subject(
+            subject_name=subject_name,
+            url=launch_link[0].strip(),
+            attendance=attendance[0].text_content().strip() if attendance else "---"
+        ))
+    return subjects
+
+def parse_logout_link(dashboard_html: str) -> str:
+    tree = parse_page(dashboard_html)
+    logout_link = LOGOUT_LINK(tree) if tree is not None else []
+    if not logout_link:
+        return ""
+    logout_url = logout_link[0]
+    if not logout_url.startswith('http'):
+        logout_url = f"{LMS_BASE_URL}{logout_url}"
+    return logout_url
+
+def parse_activities(subject_html: str) -> list[Activity]:
+    tree = parse_page(subject_html)
+    activities = []
+    for activity in (ACTIVITIES(tree) if tree is not None else []):
+        file_link = ACTIVITY_LINK(activity)
+        file_name = ACTIVITY_NAME(activity)
+        if not file_link or not file_name:
+            continue
+        # Only the leading text; the nested accesshide span holds the activity type
+        activities.append(Activity(file_link[0], file_name[0].text or ""))
+    return activities
+
+def parse_resource_link(resource_html: str):
+    match = RESOURCE_LINK.search(resource_html)
+    return match.group(1) if match else None
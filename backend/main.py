@@ -1,29 +1,75 @@
 from fastapi import FastAPI, Request,Response, HTTPException
-from ingestion import ingestData
-from cache import checkCache
-from response_generation import generateResponse
-from lms_handling import logIn, logOut, fetchFiles
+from fastapi.responses import StreamingResponse, PlainTextResponse
+from cache import checkCache, MEMORY_CACHE
+from semantic_cache import checkSemanticCache, SEMANTIC_CACHE_STATS
+from response_generation import generateResponse, streamResponse, EXPANSION_CACHE
+from embedding_cache import EMBEDDING_MEMORY_CACHE
+from lms_handling import logIn, logOut, fetchFiles, streamFiles, close_clients, prune_clients, get_session
+from ingestion import listDocuments, deleteDocuments
+from sessions import SESSION_STORE
+from llm_scheduler import LLM_SCHEDULER
+from jobs import JOB_QUEUE
+import workers
+from metrics import span, observe, render_metrics, request_id, RequestIdFilter
 from contextlib import asynccontextmanager
 from cache import init_db
-import logging
+from uuid import uuid4
+import logging, json, time
 
 
-root_logger = logging.getLogger()
-root_logger.setLevel(logging.INFO)
+# force replaces the handler an import-time logging call may already have installed through the implicit basicConfig
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s %(levelname)s [%(request_id)s] %(name)s: %(message)s",
+    force=True
+)
+for log_handler in logging.getLogger().handlers:
+    log_handler.addFilter(RequestIdFilter())
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     await init_db()
+    JOB_QUEUE.start()
+    SESSION_STORE.start(prune_clients)
     yield
+    await SESSION_STORE.stop()
+    await JOB_QUEUE.stop()
+    await close_clients()
+    workers.shutdown()
 app = FastAPI(lifespan=lifespan)
 
+@app.middleware("http")
+async def track_request(request: Request, call_next):
+    request_id.set(request.headers.get("X-Request-ID") or uuid4().hex[:12])
+    start = time.perf_counter()
+    response = await call_next(request)
+    route = request.scope.get("route")
+    observe(f"http {request.method} {route.path if route else 'unmatched'}", time.perf_counter() - start)
+    response.headers["X-Request-ID"] = request_id.get()
+    return response
+
+@app.get("/metrics")
+async def metrics():
+    gauges = {
+        f"rag_llm_{key}": value for key, value in LLM_SCHEDULER.stats().items()
+    }
+    gauges.update({f"rag_qa_memory_cache_{key}": value for key, value in MEMORY_CACHE.stats().items()})
+    gauges.update({f"rag_expansion_cache_{key}": value for key, value in EXPANSION_CACHE.stats().items()})
+    gauges.update({f"rag_embedding_memory_cache_{key}": value for key, value in EMBEDDING_MEMORY_CACHE.stats().items()})
+    gauges.update({f"rag_semantic_cache_{key}": value for key, value in SEMANTIC_CACHE_STATS.items()})
+    gauges.update({f"rag_ingest_jobs_{key}": value for key, value in JOB_QUEUE.stats().items()})
+    gauges["rag_lms_sessions"] = await SESSION_STORE.count()
+    gauges["rag_lms_sessions_swept"] = SESSION_STORE.swept
+    return PlainTextResponse(render_metrics(gauges), media_type="text/plain; version=0.0.4")
+
 
 @app.post("/login")
 async def loginToLMS(request: Request, response:Response):
     data = await request.json()
     username = data.get("username")
     password = data.get("password")
-    status_code, subjects, logout_url, session_id = logIn(username,password)
+    with span("lms_login"):
+        status_code, subjects, logout_url, session_id = await logIn(username,password)
     response.status_code = status_code
     return {
         "status": status_code,
@@ -35,7 +81,8 @@ async def loginToLMS(request: Request, response:Response):
 @app.get("/logout")
 async def logoutOfLMS(request: Request, response:Response):
     session_id = request.query_params.get("session_id")
-    status_code = logOut(session_id)
+    with span("lms_logout"):
+        status_code = await logOut(session_id)
     response.status_code = status_code
     return {}
 
@@ -45,10 +92,29 @@ async def fetchSubjectFiles(request: Request, response: Response):
     session_id = data.get("session_id")
     subject = data.get("subject")
     subject_url = data.get("url")
-    status_code,files = fetchFiles(session_id,subject,subject_url)
+    refresh = data.get("refresh", False)
+    with span("lms_fetch"):
+        status_code,files = await fetchFiles(session_id,subject,subject_url,refresh)
     response.status_code = status_code
     return {"files": files}
 
+@app.post("/fetch/stream")
+async def streamSubjectFiles(request: Request):
+    data = await request.json()
+    session_id = data.get("session_id")
+    subject = data.get("subject")
+    subject_url = data.get("url")
+    refresh = data.get("refresh", False)
+    # Checked up front, since once streaming starts the status code can no longer change
+    if not await get_session(session_id):
+        raise HTTPException(status_code=401, detail="unauthorized session")
+
+    async def events():
+        async for file in streamFiles(session_id,subject,subject_url,refresh):
+            yield json.dumps(file) + "\n"
+
+    return StreamingResponse(events(), media_type="application/x-ndjson")
+
 @app.post("/upload")
 async def receive_file(request: Request):
     data = await request.json()
@@ -57,25 +123,52 @@ async def receive_file(request: Request):
     file_name = data.get("file_name")
     file_link = data.get("file_link")
     
-    status = await ingestData(subject,file_name,file_link,session_id)
-    return {"status": status}
+    job = JOB_QUEUE.submit(subject,file_name,file_link,session_id)
+    return {"job_id": job.id, "status": job.status}
+
+@app.post("/upload/batch")
+async def receive_files(request: Request):
+    data = await request.json()
+    session_id = data.get("session_id")
+    jobs = [
+        JOB_QUEUE.submit(f.get("subject"),f.get("file_name"),f.get("file_link"),session_id)
+        for f in data.get("files", [])
+    ]
+    return {"jobs": [{"job_id": job.id, "file_link": job.file_link, "status": job.status} for job in jobs]}
+
+@app.get("/jobs/{job_id}")
+async def job_status(job_id: str):
+    job = JOB_QUEUE.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="job not found")
+    return job.to_dict()
+
+@app.get("/documents")
+async def list_documents(subject: str = None):
+    return {"documents": await listDocuments(subject)}
+
+@app.delete("/documents")
+async def delete_documents(subject: str, session_id: str = None, content_hash: str = None):
+    if not await get_session(session_id):
+        raise HTTPException(status_code=401, detail="unauthorized session")
+    with span("document_delete"):
+        deleted = await deleteDocuments(subject, content_hash)
+    return {"deleted": deleted}
 
 @app.post("/query")
 async def query_llm(request: Request):
     data = await request.json()
     questions = data.get("questions")
     answers,unanswered = await checkCache(questions)
+    await checkSemanticCache(questions, answers, unanswered, data.get("subjects"))
     not_cached = [i for i, result in enumerate(answers) if result is None]
     if not_cached:
         logging.info(f"Answers for questions {not_cached} weren't in cache. Generating answers ...")
         generated_answers = await generateResponse(unanswered)
         if generated_answers:
             logging.info("Answer generation successful")
-            generated_index = 0
-            for i, ans in enumerate(answers):
-                if ans is None:
-                    answers[i] = generated_answers[generated_index]
-                    generated_index += 1
+            for i in not_cached:
+                answers[i] = generated_answers[i]
             return {"answers":answers}
         else:
             logging.error("Answer generation failed")
@@ -83,3 +176,25 @@ async def query_llm(request: Request):
     else:
         logging.info("Answers found in cache. Skipping generation ...")
         return {"answers":answers}
+
+
+@app.post("/query/stream")
+async def stream_query_llm(request: Request):
+    data = await request.json()
+    questions = data.get("questions")
+    stream_tokens = data.get("stream_tokens", False)
+    answers,unanswered = await checkCache(questions)
+    await checkSemanticCache(questions, answers, unanswered, data.get("subjects"))
+
+    async def events():
+        for i, ans in enumerate(answers):
+            if ans is not None:
+                yield json.dumps({"index": i, "answer": ans, "cached": True}) + "\n"
+        async for event in streamResponse(unanswered, stream_tokens):
+            yield json.dumps(event) + "\n"
+
+    return StreamingResponse(events(), media_type="application/x-ndjson")
+
+@app.get("/llm/stats")
+async def llm_scheduler_stats():
+    return LLM_SCHEDULER.stats()
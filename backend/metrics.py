@@ -0,0 +1,79 @@
+import time, logging, functools
+from contextlib import contextmanager
+from contextvars import ContextVar
+from collections import defaultdict
+
+# Upper bounds in seconds, spanning cache hits through slow LLM calls and large ingests
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+request_id = ContextVar("request_id", default="-")
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+STAGE_DURATIONS = defaultdict(Histogram)
+STAGE_ERRORS = defaultdict(int)
+
+def observe(stage: str, seconds: float):
+    STAGE_DURATIONS[stage].observe(seconds)
+
+@contextmanager
+def span(stage: str):
+    """Times the enclosed block into the stage's histogram; usable in sync and async code."""
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        STAGE_ERRORS[stage] += 1
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        observe(stage, elapsed)
+        logging.debug(f"{stage} took {elapsed*1000:.1f}ms")
+
+def timed(stage: str):
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with span(stage):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+class RequestIdFilter(logging.Filter):
+    def filter(self, record):
+        record.request_id = request_id.get()
+        return True
+
+def render_metrics(gauges: dict[str, float] = None) -> str:
+    lines = [
+        "# HELP rag_stage_duration_seconds Time spent in each pipeline stage.",
+        "# TYPE rag_stage_duration_seconds histogram"
+    ]
+    for stage, histogram in sorted(STAGE_DURATIONS.items()):
+        for bound, count in zip(histogram.buckets, histogram.counts):
+            lines.append(f'rag_stage_duration_seconds_bucket{{stage="{stage}",le="{bound}"}} {count}')
+        lines.append(f'rag_stage_duration_seconds_bucket{{stage="{stage}",le="+Inf"}} {histogram.count}')
+        lines.append(f'rag_stage_duration_seconds_sum{{stage="{stage}"}} {histogram.sum}')
+        lines.append(f'rag_stage_duration_seconds_count{{stage="{stage}"}} {histogram.count}')
+
+    lines.append("# HELP rag_stage_errors_total Pipeline stages that raised.")
+    lines.append("# TYPE rag_stage_errors_total counter")
+    for stage, count in sorted(STAGE_ERRORS.items()):
+        lines.append(f'rag_stage_errors_total{{stage="{stage}"}} {count}')
+
+    for name, value in sorted((gauges or {}).items()):
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,84 @@
+from qdrant_client import QdrantClient
+from qdrant_client.http.models import (
+    Distance, VectorParams, VectorParamsDiff, HnswConfigDiff, CollectionParamsDiff, PayloadSchemaType, ScalarQuantization,
+    ScalarQuantizationConfig, ScalarType, SearchParams, QuantizationSearchParams, Disabled
+)
+import logging, os
+from dotenv import load_dotenv
+load_dotenv()
+
+VECTOR_SIZE = 384
+QDRANT_HNSW_M = int(os.environ.get("QDRANT_HNSW_M", 16))
+QDRANT_HNSW_EF_CONSTRUCT = int(os.environ.get("QDRANT_HNSW_EF_CONSTRUCT", 128))
+# int8 copies of the vectors stay in RAM for search while the float32 originals live on disk for rescoring
+QDRANT_QUANTIZATION = os.environ.get("QDRANT_QUANTIZATION", "int8").lower() == "int8"
+QDRANT_QUANTILE = float(os.environ.get("QDRANT_QUANTILE", 0.99))
+QDRANT_VECTORS_ON_DISK = os.environ.get("QDRANT_VECTORS_ON_DISK", "true").lower() == "true"
+QDRANT_PAYLOAD_ON_DISK = os.environ.get("QDRANT_PAYLOAD_ON_DISK", "true").lower() == "true"
+QDRANT_RESCORE = os.environ.get("QDRANT_RESCORE", "true").lower() == "true"
+QDRANT_OVERSAMPLING = float(os.environ.get("QDRANT_OVERSAMPLING", 2.0))
+
+# Payload fields filtered on by dedup checks, re-ingestion diffs, subject deletes and the semantic cache
+DOCUMENT_INDEXES = ("metadata.content_hash", "metadata.subject", "metadata.file_link", "metadata.source_key")
+QA_CACHE_INDEXES = ("question_hash", "subjects")
+
+def quantization_config():
+    if not QDRANT_QUANTIZATION:
+        return None
+    return ScalarQuantization(scalar=ScalarQuantizationConfig(type=ScalarType.INT8, quantile=QDRANT_QUANTILE, always_ram=True))
+
+def search_params():
+    """Search over the quantized vectors, re-ranking an oversampled candidate set with the originals."""
+    if not QDRANT_QUANTIZATION:
+        return None
+    return SearchParams(quantization=QuantizationSearchParams(rescore=QDRANT_RESCORE, oversampling=QDRANT_OVERSAMPLING))
+
+def ensure_collection(client: QdrantClient, collection_name: str, payload_indexes=()):
+    """Creates the collection with the configured tuning, or migrates an existing one to it in place."""
+    if not client.collection_exists(collection_name):
+        logging.info(f"Creating Qdrant collection {collection_name}")
+        client.create_collection(
+            collection_name=collection_name,
+            vectors_config=VectorParams(size=VECTOR_SIZE, distance=Distance.COSINE, on_disk=QDRANT_VECTORS_ON_DISK),
+            hnsw_config=HnswConfigDiff(m=QDRANT_HNSW_M, ef_construct=QDRANT_HNSW_EF_CONSTRUCT),
+            quantization_config=quantization_config(),
+            on_disk_payload=QDRANT_PAYLOAD_ON_DISK
+        )
+    else:
+        try:
+            migrate_collection(client, collection_name)
+        except Exception as e:
+            # An untuned collection still serves correctly, so a failed migration shouldn't stop startup
+            logging.error(f"Failed to migrate Qdrant collection {collection_name}: {e}")
+    ensure_payload_indexes(client, collection_name, payload_indexes)
+
+def migrate_collection(client: QdrantClient, collection_name: str):
+    config = client.get_collection(collection_name).config
+    changes = {}
+    hnsw = config.hnsw_config
+    if hnsw.m != QDRANT_HNSW_M or hnsw.ef_construct != QDRANT_HNSW_EF_CONSTRUCT:
+        changes["hnsw_config"] = HnswConfigDiff(m=QDRANT_HNSW_M, ef_construct=QDRANT_HNSW_EF_CONSTRUCT)
+    vectors = config.params.vectors
+    if isinstance(vectors, VectorParams) and bool(vectors.on_disk) != QDRANT_VECTORS_ON_DISK:
+        changes["vectors_config"] = {"": VectorParamsDiff(on_disk=QDRANT_VECTORS_ON_DISK)}
+    if bool(config.params.on_disk_payload) != QDRANT_PAYLOAD_ON_DISK:
+        changes["collection_params"] = CollectionParamsDiff(on_disk_payload=QDRANT_PAYLOAD_ON_DISK)
+    # Compared field by field, so a changed quantile or always_ram is applied too, not just turning quantization on or off
+    if config.quantization_config != quantization_config():
+        # Qdrant takes Disabled rather than None to drop quantization
+        changes["quantization_config"] = quantization_config() or Disabled.DISABLED
+    if not changes:
+        return
+    logging.info(f"Migrating Qdrant collection {collection_name}: {', '.join(changes)}")
+    # Qdrant applies these in the background, re-indexing segments while the collection keeps serving
+    client.update_collection(collection_name=collection_name, **changes)
+
+def ensure_payload_indexes(client: QdrantClient, collection_name: str, fields):
+    existing = client.get_collection(collection_name).payload_schema or {}
+    for field in fields:
+        if field in existing:
+            continue
+        try:
+            client.create_payload_index(collection_name, field_name=field, field_schema=PayloadSchemaType.KEYWORD)
+        except Exception as e:
+            logging.error(f"Failed to create payload index on {collection_name}.{field}: {e}")
@@ -1,8 +1,14 @@
 from langchain_google_genai import ChatGoogleGenerativeAI
 from dotenv import load_dotenv
-from ingestion import QDRANT_INSTANCE
-import logging, asyncio
-from cache import add_qa_entry
+from langchain.docstore.document import Document as LangchainDocument
+from qdrant_client.http.models import QueryRequest
+from ingestion import QDRANT_INSTANCE, QDRANT_COLLECTION_NAME, client, embed_queries
+from qdrant_collections import search_params
+import logging, asyncio, os, re, json
+from cache import add_qa_entries, get_generation, MemoryCache, normalize_question
+from llm_scheduler import LLM_SCHEDULER, PRIORITY_ANSWER, PRIORITY_SUB_QUERY
+from semantic_cache import index_questions
+from metrics import timed
 
 logger = logging.getLogger(__name__)
 
@@ -11,11 +17,34 @@ load_dotenv()
 try:
     llm = ChatGoogleGenerativeAI(
         model="gemini-2.0-flash",
-        max_tokens=250)
+        max_tokens=250,
+        # Retries are owned by LLM_SCHEDULER so they count against its shared budget
+        max_retries=1)
 except Exception as e:
     logging.error(f"Failed to initialize Gemini: {e}")
     exit()
 
+RETRIEVAL_TOP_K = int(os.environ.get("RETRIEVAL_TOP_K", 3))
+# Caps concurrent Qdrant batch searches across every question in every request
+RETRIEVAL_CONCURRENCY = int(os.environ.get("RETRIEVAL_CONCURRENCY", 8))
+retrieval_limiter = asyncio.Semaphore(RETRIEVAL_CONCURRENCY)
+
+# llm: one LLM call per question, batched: one LLM call per request, local: keyword expansion, off: raw question
+QUERY_EXPANSION_MODE = os.environ.get("QUERY_EXPANSION_MODE", "llm").lower()
+EXPANSION_CACHE = MemoryCache(
+    int(os.environ.get("EXPANSION_CACHE_SIZE", 4096)),
+    float(os.environ.get("EXPANSION_CACHE_TTL", 86400))
+)
+ANSWER_BATCHING = os.environ.get("ANSWER_BATCHING", "false").lower() == "true"
+ANSWER_BATCH_SIZE = int(os.environ.get("ANSWER_BATCH_SIZE", 5))
+ANSWER_BATCH_MAX_CHUNKS = int(os.environ.get("ANSWER_BATCH_MAX_CHUNKS", 15))
+STOPWORDS = {
+    "a", "an", "the", "is", "are", "was", "were", "be", "been", "do", "does", "did", "what", "which", "who",
+    "whom", "when", "where", "why", "how", "of", "in", "on", "for", "to", "and", "or", "with", "by", "at",
+    "from", "this", "that", "these", "those", "there", "it", "its", "can", "could", "should", "would", "will",
+    "under", "any", "about", "me", "i", "my", "we", "our", "you", "your", "explain", "describe", "define"
+}
+
 async def generate_sub_queries(user_question: str) -> list[str]:
     logging.info("Generating sub-queries...")
     sub_query_prompt = f"""
@@ -28,7 +57,7 @@ async def generate_sub_queries(user_question: str) -> list[str]:
     """
 
     try:
-        completion = await llm.ainvoke(sub_query_prompt)
+        completion = await LLM_SCHEDULER.run(PRIORITY_SUB_QUERY, lambda: llm.ainvoke(sub_query_prompt))
         response_text = completion.content
         sub_queries = [q.strip() for q in response_text.split(',') if q.strip()]
         logging.info(f"Generated sub-queries: {sub_queries}")
@@ -37,29 +66,134 @@ async def generate_sub_queries(user_question: str) -> list[str]:
         logging.error(f"Error generating sub-queries: {e}")
         return [user_question]
 
-async def retrieve_and_synthesize_context(queries: list[str]) -> str:
-    full_context = ""
-    unique_contexts = set()
+async def generate_sub_queries_batch(user_questions: list[str]) -> dict[str, list[str]]:
+    logging.info(f"Generating sub-queries for {len(user_questions)} questions in one call...")
+    numbered = "\n".join(f"{i+1}. {q}" for i, q in enumerate(user_questions))
+    sub_query_prompt = f"""
+    You are a query generation expert. Your task is to take each user question about an insurance policy and break it down into 3 highly specific and effective search queries. These queries should be designed to retrieve the most relevant information from a technical document.
+
+    User Questions:
+    {numbered}
+
+    Respond with only a JSON object mapping each question number to its list of queries, without any extra text.
+    For example: {{"1": ["grace period for premium payment", "due date for premium", "policy renewal grace period"]}}
+    """
+
+    expansions = {q: [q] for q in user_questions}
+    try:
+        completion = await LLM_SCHEDULER.run(PRIORITY_SUB_QUERY, lambda: llm.ainvoke(sub_query_prompt))
+        response_text = re.sub(r"^```(?:json)?|```$", "", completion.content.strip()).strip()
+        for key, sub_queries in json.loads(response_text).items():
+            index = int(key) - 1
+            sub_queries = [str(q).strip() for q in sub_queries if str(q).strip()]
+            if 0 <= index < len(user_questions) and sub_queries:
+                expansions[user_questions[index]] = sub_queries
+        logging.info(f"Generated sub-queries: {expansions}")
+    except Exception as e:
+        logging.error(f"Error generating batched sub-queries: {e}")
+    return expansions
+
+def local_sub_queries(user_question: str) -> list[str]:
+    keywords = [w for w in re.findall(r"\w+", user_question.lower()) if w not in STOPWORDS]
+    sub_queries = [user_question]
+    if keywords:
+        sub_queries.append(" ".join(keywords))
+    if len(keywords) > 3:
+        sub_queries.append(" ".join(keywords[-3:]))
+    return list(dict.fromkeys(sub_queries))
+
+@timed("sub_query")
+async def expand_questions(questions: list[str]) -> dict[str, list[str]]:
+    """Maps each question to its search queries per QUERY_EXPANSION_MODE, memoized by normalized question."""
+    expansions = {}
+    missing = []
+    for q in dict.fromkeys(questions):
+        if q == "Cached":
+            continue
+        cached = EXPANSION_CACHE.get(normalize_question(q))
+        if cached:
+            expansions[q] = cached
+        else:
+            missing.append(q)
+    if not missing:
+        return expansions
+
+    if QUERY_EXPANSION_MODE == "off":
+        generated = {q: [q] for q in missing}
+    elif QUERY_EXPANSION_MODE == "local":
+        generated = {q: local_sub_queries(q) for q in missing}
+    elif QUERY_EXPANSION_MODE == "batched":
+        generated = await generate_sub_queries_batch(missing)
+    else:
+        results = await asyncio.gather(*[generate_sub_queries(q) for q in missing])
+        generated = dict(zip(missing, results))
+
+    for q, sub_queries in generated.items():
+        # [q] is also the failure fallback, so it isn't worth remembering
+        if sub_queries != [q]:
+            EXPANSION_CACHE.put(normalize_question(q), sub_queries)
+        expansions[q] = sub_queries
+    return expansions
+
+async def search_queries(queries: list[str]) -> list[list[LangchainDocument]]:
+    """Embeds all queries in one batch and runs their searches as a single Qdrant batch request."""
+    if not queries:
+        return []
+    vectors = await embed_queries(queries)
+    requests = [QueryRequest(query=vector, limit=RETRIEVAL_TOP_K, with_payload=True, params=search_params()) for vector in vectors]
+    async with retrieval_limiter:
+        results = await asyncio.to_thread(
+            client.query_batch_points,
+            collection_name=QDRANT_COLLECTION_NAME,
+            requests=requests
+        )
+    return [
+        [
+            LangchainDocument(
+                page_content=point.payload.get(QDRANT_INSTANCE.content_payload_key) or "",
+                metadata=point.payload.get(QDRANT_INSTANCE.metadata_payload_key) or {}
+            )
+            for point in result.points
+        ]
+        for result in results
+    ]
+
+@timed("retrieval")
+async def retrieve_context_chunks(queries: list[str]) -> tuple[list[str], dict]:
+    unique_contexts = {}
+    sources = {"content_hashes": set(), "subjects": set()}
 
     logging.info(f"Retrieving context for {len(queries)} queries...")
-    for query in queries:
-        try:
-            results = await QDRANT_INSTANCE.asimilarity_search(query, k=3)
+    try:
+        for results in await search_queries(queries):
             for doc in results:
-                unique_contexts.add(doc.page_content)
-        except Exception as e:
-            logging.error(f"Error during retrieval for query '{query}': {e}")
+                unique_contexts[doc.page_content] = None
+                sources["content_hashes"].add(doc.metadata.get("content_hash"))
+                sources["subjects"].add(doc.metadata.get("subject"))
+    except Exception as e:
+        logging.error(f"Error during retrieval for queries {queries}: {e}")
+
+    sources = {key: {v for v in values if v} for key, values in sources.items()}
+    return list(unique_contexts), sources
+
+async def retrieve_and_synthesize_context(queries: list[str]) -> tuple[str, dict]:
+    full_context = ""
+    chunks, sources = await retrieve_context_chunks(queries)
             
     try:
-        full_context = "\n\n---\n\n".join(list(unique_contexts))
+        full_context = "\n\n---\n\n".join(chunks)
         logging.info("Context retrieval and synthesis complete.")
     except Exception as e:
         logging.error(f"Error during context synthesis: {e}")
         full_context = "Error synthesizing context."
 
-    return full_context
+    return full_context, sources
 
-async def answer_question_with_context(question: str, context: str) -> str:
+# Returned in place of an answer when generation fails; never cached
+ANSWER_ERROR = "An error occurred while trying to answer the question."
+
+@timed("synthesis")
+async def answer_question_with_context(question: str, context: str, on_token=None) -> str:
     logging.info("Generating final answer...")
     final_prompt = f"""
     <|begin_of_text|>
@@ -83,41 +217,214 @@ async def answer_question_with_context(question: str, context: str) -> str:
     
     try:
         llm_with_limited_tokens = llm.with_config({"configurable": {"max_output_tokens": 50}})
-        completion = await llm_with_limited_tokens.ainvoke(final_prompt)
-        answer = completion.content.strip()
+        if on_token:
+            parts = []
+            async def stream_answer():
+                async for chunk in llm_with_limited_tokens.astream(final_prompt):
+                    if chunk.content:
+                        parts.append(chunk.content)
+                        on_token(chunk.content)
+            # Tokens already sent to the client can't be taken back, so only retry before the first one
+            await LLM_SCHEDULER.run(PRIORITY_ANSWER, stream_answer, can_retry=lambda: not parts)
+            answer = "".join(parts).strip()
+        else:
+            completion = await LLM_SCHEDULER.run(PRIORITY_ANSWER, lambda: llm_with_limited_tokens.ainvoke(final_prompt))
+            answer = completion.content.strip()
         logging.info("Final answer generated successfully.")
         return answer
     except Exception as e:
         logging.error(f"Error generating final answer with the LLM: {e}")
-        return "An error occurred while trying to answer the question."
+        return ANSWER_ERROR
+
+@timed("synthesis")
+async def answer_questions_with_shared_context(questions: list[str], context: str) -> list[str] | None:
+    logging.info(f"Generating final answers for {len(questions)} questions in one call...")
+    numbered = "\n".join(f"{i+1}. {q}" for i, q in enumerate(questions))
+    final_prompt = f"""
+    <|begin_of_text|>
+    <|start_header_id|>system<|end_header_id|>
+    You are an expert insurance policy document assistant. Provide a concise and accurate answer to each of the user's questions based ONLY on the provided context.
+    - Start with 'Yes' or 'No' if it is a direct yes/no question.
+    - Extract all specific numbers, percentages, and conditions directly from the text.
+    - If the answer is descriptive, provide a brief, well-structured summary.
+    - If the context does not contain the answer, state that the information is not available in the document.
+    - Respond with only a JSON object mapping each question number to its answer, without any extra text.
+
+    Context:
+    {context}
+    <|eot_id|>
 
-async def full_rag_pipeline(question) -> str:
-    sub_queries = await generate_sub_queries(question)
-    context = await retrieve_and_synthesize_context(sub_queries)
-    answer = await answer_question_with_context(question, context)
-    return answer
+    <|start_header_id|>user<|end_header_id|>
+    Questions:
+    {numbered}
+    <|eot_id|>
 
-async def process_question(i,q):
-    print(f"\nQuestion {i+1}: {q}")
+    <|start_header_id|>assistant<|end_header_id|>
+    """
+
+    try:
+        llm_with_limited_tokens = llm.with_config({"configurable": {"max_output_tokens": 50 * len(questions)}})
+        completion = await LLM_SCHEDULER.run(PRIORITY_ANSWER, lambda: llm_with_limited_tokens.ainvoke(final_prompt))
+        response_text = re.sub(r"^```(?:json)?|```$", "", completion.content.strip()).strip()
+        parsed = json.loads(response_text)
+        answers = [str(parsed[str(i+1)]).strip() for i in range(len(questions))]
+        logging.info("Batched final answers generated successfully.")
+        return answers
+    except Exception as e:
+        logging.error(f"Error generating batched final answers, falling back to per-question calls: {e}")
+        return None
+
+def group_by_context(retrieved: dict[int, list[str]]) -> list[list[int]]:
+    """Greedily groups questions whose retrieved chunks overlap, bounded in questions and combined chunks."""
+    groups = []
+    for i, chunks in retrieved.items():
+        chunk_set = set(chunks)
+        for indexes, group_chunks in groups:
+            if (len(indexes) < ANSWER_BATCH_SIZE and chunk_set & group_chunks
+                    and len(chunk_set | group_chunks) <= ANSWER_BATCH_MAX_CHUNKS):
+                indexes.append(i)
+                group_chunks |= chunk_set
+                break
+        else:
+            groups.append(([i], chunk_set))
+    return [indexes for indexes, _ in groups]
+
+async def batched_rag_pipeline(questions, on_answer=None) -> dict[int, tuple[str, dict]]:
+    """Answers uncached questions, sharing one LLM call between questions with overlapping context."""
+    indexes = [i for i, q in enumerate(questions) if q != "Cached"]
+    expansions = await expand_questions([questions[i] for i in indexes])
+    retrievals = await asyncio.gather(*[retrieve_context_chunks(expansions[questions[i]]) for i in indexes])
+    retrieved = {i: chunks for i, (chunks, _) in zip(indexes, retrievals)}
+    retrieved_sources = {i: sources for i, (_, sources) in zip(indexes, retrievals)}
+    results = {}
+
+    async def answer_group(group):
+        chunks = list(dict.fromkeys(chunk for i in group for chunk in retrieved[i]))
+        context = "\n\n---\n\n".join(chunks)
+        sources = {
+            key: set().union(*(retrieved_sources[i][key] for i in group))
+            for key in ("content_hashes", "subjects")
+        }
+        answers = None
+        if len(group) > 1:
+            answers = await answer_questions_with_shared_context([questions[i] for i in group], context)
+        if answers is None:
+            answers = await asyncio.gather(*[
+                answer_question_with_context(questions[i], "\n\n---\n\n".join(retrieved[i])) for i in group
+            ])
+            sources = None
+        for i, answer in zip(group, answers):
+            results[i] = (answer, sources or retrieved_sources[i])
+            if on_answer:
+                on_answer(i, answer)
+
+    groups = group_by_context(retrieved)
+    logging.info(f"Answering {len(indexes)} questions in {len(groups)} LLM calls")
+    await asyncio.gather(*[answer_group(group) for group in groups])
+    return results
+
+async def full_rag_pipeline(question, on_token=None, sub_queries=None) -> tuple[str, dict]:
+    if sub_queries is None:
+        sub_queries = (await expand_questions([question]))[question]
+    context, sources = await retrieve_and_synthesize_context(sub_queries)
+    answer = await answer_question_with_context(question, context, on_token)
+    return answer, sources
+
+async def process_question(i,q,sub_queries=None):
     if q == "Cached":
-        return "Cached"
-    response = await full_rag_pipeline(q)
-    print(f"Answer: {response}")
-    print("-----------------------------------")
-    return response
+        return "Cached", None
+    logging.info(f"Answering question {i+1}: {q}")
+    response, sources = await full_rag_pipeline(q, sub_queries=sub_queries)
+    logging.info(f"Answer {i+1}: {response}")
+    return response, sources
     
+@timed("cache_write")
+async def store_answers(questions, answers, sources, generation=None) -> bool:
+    # Failed answers are left uncached so the question is generated again next time
+    stored = [i for i,(q,a) in enumerate(zip(questions,answers)) if q != "Cached" and a != ANSWER_ERROR]
+    generated = [(questions[i],answers[i]) for i in stored]
+    generated_sources = [sources[i] for i in stored]
+    try:
+        await add_qa_entries(generated, generated_sources, generation)
+    except Exception as e:
+        logging.error(f"Failed to insert {len(generated)} cache entries: {e}")
+        return False
+    await index_questions([q for q,_ in generated], generated_sources)
+    return True
+
 async def generateResponse(questions) -> list:
-    print("\n--- Starting RAG Query Process ---")
-    
-    tasks = [process_question(i,q) for i,q in enumerate(questions)]
-    answers = await asyncio.gather(*tasks)
+    logging.info("Starting RAG query process")
+    # Read before retrieval, so answers built from documents re-ingested meanwhile aren't cached
+    generation = await get_generation()
     
-    db_entry = [add_qa_entry(q,a) for i,(q,a) in enumerate(zip(questions,answers))]
-    check = await asyncio.gather(*db_entry)
+    if ANSWER_BATCHING:
+        generated = await batched_rag_pipeline(questions)
+        results = [generated.get(i, ("Cached", None)) for i in range(len(questions))]
+    else:
+        expansions = await expand_questions(questions) if QUERY_EXPANSION_MODE == "batched" else {}
+        tasks = [process_question(i,q,expansions.get(q)) for i,q in enumerate(questions)]
+        results = await asyncio.gather(*tasks)
+    answers = [answer for answer, _ in results]
+    sources = [source for _, source in results]
     
-    failed = [i for i, result in enumerate(check) if result is None]
-    if failed:
-        logging.error(f"Failed to insert entries at indexes: {failed}")
+    if not await store_answers(questions, answers, sources, generation):
+        return None
+    logging.info("RAG query process complete")
+    return answers
+
+def answer_event(i: int, answer: str) -> dict:
+    if answer == ANSWER_ERROR:
+        return {"index": i, "error": answer}
+    return {"index": i, "answer": answer}
+
+async def streamResponse(questions, stream_tokens: bool = False):
+    """Yields {"index", "answer"} events as each uncached question finishes, in completion order.
+
+    With stream_tokens, {"index", "token"} events are emitted while each answer is being generated. A failed answer
+    yields {"index", "error"} instead, so clients know any tokens already streamed for it are a truncated answer.
+    """
+    events = asyncio.Queue()
+    generation = await get_generation()
+
+    async def run(i, q, sub_queries):
+        on_token = (lambda token: events.put_nowait({"index": i, "token": token})) if stream_tokens else None
+        try:
+            answer, sources = await full_rag_pipeline(q, on_token, sub_queries)
+        except Exception as e:
+            logging.error(f"RAG pipeline failed for question {i+1}: {e}")
+            answer, sources = ANSWER_ERROR, None
+        events.put_nowait(answer_event(i, answer))
+        return answer, sources
+
+    async def run_each():
+        expansions = await expand_questions(questions) if QUERY_EXPANSION_MODE == "batched" else {}
+        indexes = [i for i,q in enumerate(questions) if q != "Cached"]
+        results = await asyncio.gather(*[run(i, questions[i], expansions.get(questions[i])) for i in indexes])
+        return dict(zip(indexes, results))
+
+    if ANSWER_BATCHING and not stream_tokens:
+        pipeline = asyncio.create_task(
+            batched_rag_pipeline(questions, lambda i, answer: events.put_nowait(answer_event(i, answer)))
+        )
     else:
-        print("--- RAG Query Process Complete ---")
-        return answers
\ No newline at end of file
+        pipeline = asyncio.create_task(run_each())
+    # Wakes the consumer once every answer event is queued, or if the pipeline dies early
+    pipeline.add_done_callback(lambda _: events.put_nowait(None))
+    try:
+        while (event := await events.get()) is not None:
+            yield event
+    except BaseException:
+        # The client went away mid-stream, so there is nobody left to answer
+        pipeline.cancel()
+        raise
+
+    try:
+        generated = await pipeline
+    except Exception as e:
+        logging.error(f"RAG pipeline failed: {e}")
+        return
+    answers = ["Cached"] * len(questions)
+    sources = [None] * len(questions)
+    for i, (answer, source) in generated.items():
+        answers[i], sources[i] = answer, source
+    await store_answers(questions, answers, sources, generation)
\ No newline at end of file
@@ -0,0 +1,124 @@
+from qdrant_client.http.models import PointStruct, QueryRequest, PointIdsList, Filter, FieldCondition, MatchAny
+from ingestion import client, embed_queries
+from cache import get_answers, normalize_question, question_key, register_invalidation_handler, GLOBAL_GENERATION
+from metrics import timed
+from qdrant_collections import ensure_collection, search_params, QA_CACHE_INDEXES
+import asyncio, logging, os, uuid
+from dotenv import load_dotenv
+load_dotenv()
+
+SEMANTIC_CACHE_COLLECTION_NAME = os.environ.get("SEMANTIC_CACHE_COLLECTION_NAME", "QA_CACHE")
+# Off by default: a near-duplicate question can still ask for something different, so enabling it is a deliberate trade
+SEMANTIC_CACHE_ENABLED = os.environ.get("SEMANTIC_CACHE_ENABLED", "false").lower() == "true"
+SEMANTIC_CACHE_THRESHOLD = float(os.environ.get("SEMANTIC_CACHE_THRESHOLD", 0.95))
+
+SEMANTIC_CACHE_STATS = {
+    "lookups": 0,
+    "hits": 0
+}
+
+try:
+    if SEMANTIC_CACHE_ENABLED:
+        ensure_collection(client, SEMANTIC_CACHE_COLLECTION_NAME, QA_CACHE_INDEXES)
+except Exception as e:
+    logging.error(f"Failed to prepare semantic cache collection, disabling it: {e}")
+    SEMANTIC_CACHE_ENABLED = False
+
+def point_id(question_hash: str) -> str:
+    return str(uuid.UUID(hex=question_hash[:32]))
+
+def point_subjects(source) -> list[str]:
+    # Answers built without any context are tagged with the global generation key, like their SQLite rows
+    return sorted((source or {}).get("subjects", [])) or [GLOBAL_GENERATION]
+
+def subjects_filter(subjects):
+    if not subjects:
+        return None
+    return Filter(must=[FieldCondition(key="subjects", match=MatchAny(any=[*subjects, GLOBAL_GENERATION]))])
+
+def semantic_hit_rate() -> float:
+    if not SEMANTIC_CACHE_STATS["lookups"]:
+        return 0.0
+    return SEMANTIC_CACHE_STATS["hits"] / SEMANTIC_CACHE_STATS["lookups"]
+
+@timed("semantic_cache_lookup")
+async def checkSemanticCache(questions, answers, unanswered, subjects=None) -> int:
+    """Fills exact-cache misses in place with answers to sufficiently similar cached questions.
+
+    With subjects, only answers drawn from those subjects (or from no context) are considered.
+    """
+    missing = [i for i, ans in enumerate(answers) if ans is None]
+    if not SEMANTIC_CACHE_ENABLED or not missing:
+        return 0
+
+    try:
+        vectors = await embed_queries([normalize_question(questions[i]) for i in missing])
+        requests = [
+            QueryRequest(
+                query=vector, limit=1, with_payload=True, score_threshold=SEMANTIC_CACHE_THRESHOLD,
+                filter=subjects_filter(subjects), params=search_params()
+            )
+            for vector in vectors
+        ]
+        results = await asyncio.to_thread(
+            client.query_batch_points,
+            collection_name=SEMANTIC_CACHE_COLLECTION_NAME,
+            requests=requests
+        )
+    except Exception as e:
+        logging.error(f"Semantic cache lookup failed: {e}")
+        return 0
+
+    matches = {}
+    for i, result in zip(missing, results):
+        if result.points:
+            matches[i] = result.points[0]
+    entries = await get_answers([point.payload["question_hash"] for point in matches.values()])
+
+    hits = 0
+    for i, point in matches.items():
+        entry = entries.get(point.payload["question_hash"])
+        if entry:
+            logging.info(f"Semantic cache hit for question {i+1} (score {point.score:.3f}): {entry.question}")
+            answers[i] = entry.answer
+            unanswered[i] = "Cached"
+            hits += 1
+
+    SEMANTIC_CACHE_STATS["lookups"] += len(missing)
+    SEMANTIC_CACHE_STATS["hits"] += hits
+    logging.info(f"Semantic cache answered {hits}/{len(missing)} questions, hit rate {semantic_hit_rate():.2%}")
+    return hits
+
+async def index_questions(questions: list[str], sources: list[dict] = None):
+    if not SEMANTIC_CACHE_ENABLED or not questions:
+        return
+    sources = sources or [None] * len(questions)
+    normalized = dict(zip((normalize_question(q) for q in questions), sources))
+    try:
+        vectors = await embed_queries(list(normalized))
+        points = [
+            PointStruct(
+                id=point_id(question_key(q)),
+                vector=vector,
+                payload={"question_hash": question_key(q), "question": q, "subjects": point_subjects(source)}
+            )
+            for (q, source), vector in zip(normalized.items(), vectors)
+        ]
+        await asyncio.to_thread(
+            client.upsert,
+            collection_name=SEMANTIC_CACHE_COLLECTION_NAME,
+            points=points
+        )
+    except Exception as e:
+        logging.error(f"Failed to index questions in the semantic cache: {e}")
+
+@register_invalidation_handler
+async def delete_questions(question_hashes: list[str]):
+    if not SEMANTIC_CACHE_ENABLED or not question_hashes:
+        return
+    await asyncio.to_thread(
+        client.delete,
+        collection_name=SEMANTIC_CACHE_COLLECTION_NAME,
+        points_selector=PointIdsList(points=[point_id(q_hash) for q_hash in question_hashes])
+    )
+    logging.info(f"Removed {len(question_hashes)} invalidated questions from the semantic cache")
@@ -0,0 +1,135 @@
+import asyncio, json, logging, os, time
+from sqlalchemy import Column, String, Text, Float, select, delete, func
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from cache import Base, AsyncSessionLocal, MemoryCache, engine
+from dotenv import load_dotenv
+load_dotenv()
+
+# Idle time after which a login is forgotten; every use pushes the expiry out again
+LMS_SESSION_TTL = float(os.environ.get("LMS_SESSION_TTL", 8 * 3600))
+LMS_SESSION_MAX = int(os.environ.get("LMS_SESSION_MAX", 10000))
+LMS_SESSION_SWEEP_INTERVAL = float(os.environ.get("LMS_SESSION_SWEEP_INTERVAL", 300))
+# Per-process copy in front of the table; a logout on another worker is seen here within this many seconds
+LMS_SESSION_LOCAL_TTL = float(os.environ.get("LMS_SESSION_LOCAL_TTL", 30))
+
+class LMSSession(Base):
+    __tablename__ = "lms_sessions"
+    session_id = Column(String, primary_key=True)
+    # JSON with the LMS cookies, logout URL and username. The cookies are live LMS credentials stored in plaintext,
+    # so the database file is restricted to its owner (see restrict_database_file)
+    data = Column(Text, nullable=False)
+    expires_at = Column(Float, nullable=False, index=True)
+
+def restrict_database_file():
+    path = engine.url.database
+    if engine.url.get_backend_name() != "sqlite" or not path or path == ":memory:":
+        return
+    try:
+        os.chmod(path, 0o600)
+    except OSError as e:
+        logging.error(f"Failed to restrict permissions on {path}: {e}")
+
+class SessionStore:
+    """LMS logins kept in the shared SQLite database, so any uvicorn worker can resolve a session id.
+
+    Only the login itself is shared: the HTTP clients in lms_handling.LMS_CLIENTS, the SUBJECT_FILES and
+    RESOLVED_FILES listings and the ingest JOB_QUEUE are still per process.
+    """
+
+    def __init__(self, ttl: float, max_size: int, sweep_interval: float):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.sweep_interval = sweep_interval
+        self.local = MemoryCache(max_size, LMS_SESSION_LOCAL_TTL)
+        self.sweeper = None
+        self.swept = 0
+
+    async def get(self, session_id: str):
+        if not session_id:
+            return None
+        cached = self.local.get(session_id)
+        if cached is not None:
+            return cached[0]
+        async with AsyncSessionLocal() as session:
+            row = await session.get(LMSSession, session_id)
+            if row is None or row.expires_at < time.time():
+                return None
+            data = json.loads(row.data)
+            # Sliding expiry, written back only once half the TTL has been used up
+            if row.expires_at - time.time() < self.ttl / 2:
+                row.expires_at = time.time() + self.ttl
+                await session.commit()
+        self.local.put(session_id, (data,))
+        return data
+
+    async def put(self, session_id: str, data: dict):
+        async with AsyncSessionLocal() as session:
+            stmt = sqlite_insert(LMSSession).values(
+                session_id=session_id, data=json.dumps(data), expires_at=time.time() + self.ttl
+            )
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[LMSSession.session_id],
+                set_={"data": stmt.excluded.data, "expires_at": stmt.excluded.expires_at}
+            )
+            await session.execute(stmt)
+            await session.commit()
+        self.local.put(session_id, (data,))
+        await self.enforce_limit()
+
+    async def delete(self, session_id: str):
+        async with AsyncSessionLocal() as session:
+            await session.execute(delete(LMSSession).where(LMSSession.session_id == session_id))
+            await session.commit()
+        self.local.invalidate([session_id])
+
+    async def enforce_limit(self):
+        async with AsyncSessionLocal() as session:
+            count = await session.scalar(select(func.count()).select_from(LMSSession))
+            excess = count - self.max_size
+            if excess <= 0:
+                return
+            # Sessions closest to expiry are the least recently used
+            oldest = list(await session.scalars(
+                select(LMSSession.session_id).order_by(LMSSession.expires_at).limit(excess)
+            ))
+            await session.execute(delete(LMSSession).where(LMSSession.session_id.in_(oldest)))
+            await session.commit()
+        self.local.invalidate(oldest)
+        logging.info(f"Evicted {excess} LMS sessions over the {self.max_size} session limit")
+
+    async def sweep(self) -> int:
+        async with AsyncSessionLocal() as session:
+            result = await session.execute(delete(LMSSession).where(LMSSession.expires_at < time.time()))
+            await session.commit()
+        if result.rowcount:
+            logging.info(f"Swept {result.rowcount} expired LMS sessions")
+        self.swept += result.rowcount
+        return result.rowcount
+
+    def start(self, on_sweep=None):
+        restrict_database_file()
+        self.sweeper = asyncio.create_task(self.sweep_forever(on_sweep))
+
+    async def stop(self):
+        if self.sweeper:
+            self.sweeper.cancel()
+            await asyncio.gather(self.sweeper, return_exceptions=True)
+            self.sweeper = None
+
+    async def sweep_forever(self, on_sweep=None):
+        while True:
+            try:
+                await self.sweep()
+                if on_sweep:
+                    await on_sweep()
+            except Exception as e:
+                logging.error(f"LMS session sweep failed: {e}")
+            await asyncio.sleep(self.sweep_interval)
+
+    async def count(self) -> int:
+        async with AsyncSessionLocal() as session:
+            return await session.scalar(
+                select(func.count()).select_from(LMSSession).where(LMSSession.expires_at >= time.time())
+            )
+
+SESSION_STORE = SessionStore(LMS_SESSION_TTL, LMS_SESSION_MAX, LMS_SESSION_SWEEP_INTERVAL)
@@ -0,0 +1,54 @@
+import asyncio, functools, logging, multiprocessing, os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dotenv import load_dotenv
+load_dotenv()
+
+# Extraction and embedding saturate a core each, so they run in processes to keep the event loop responsive
+CPU_WORKERS = int(os.environ.get("CPU_WORKERS", max(1, (os.cpu_count() or 2) - 1)))
+# Blocking network and Qdrant client calls
+IO_WORKERS = int(os.environ.get("IO_WORKERS", 8))
+EMBEDDING_MODEL_NAME = "BAAI/bge-small-en-v1.5"
+
+process_pool = None
+thread_pool = None
+
+def get_process_pool() -> ProcessPoolExecutor:
+    global process_pool
+    if process_pool is None:
+        # spawn keeps children from inheriting the event loop, ONNX threads and open client sockets
+        process_pool = ProcessPoolExecutor(max_workers=CPU_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        logging.info(f"Started CPU process pool with {CPU_WORKERS} workers")
+    return process_pool
+
+def get_thread_pool() -> ThreadPoolExecutor:
+    global thread_pool
+    if thread_pool is None:
+        thread_pool = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix="io")
+    return thread_pool
+
+async def run_cpu(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_process_pool(), functools.partial(func, *args, **kwargs))
+
+async def run_io(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_thread_pool(), functools.partial(func, *args, **kwargs))
+
+def shutdown():
+    global process_pool, thread_pool
+    if process_pool:
+        process_pool.shutdown(wait=False, cancel_futures=True)
+        process_pool = None
+    if thread_pool:
+        thread_pool.shutdown(wait=False, cancel_futures=True)
+        thread_pool = None
+
+embedding_model = None
+
+def embed_texts(texts: list[str]) -> list[list[float]]:
+    """Embeds in a CPU worker; each worker process loads its own copy of the model on first use."""
+    global embedding_model
+    if embedding_model is None:
+        from fastembed import TextEmbedding
+        embedding_model = TextEmbedding(model_name=EMBEDDING_MODEL_NAME)
+    return [vector.tolist() for vector in embedding_model.embed(texts)]
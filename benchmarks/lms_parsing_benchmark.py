@@ -0,0 +1,98 @@
+"""Micro-benchmark for LMS page parsing.
+
+Times backend/lms_parsing.py against the BeautifulSoup implementation it replaced, on the saved pages in
+benchmarks/fixtures/lms, and checks both produce the same records.
+
+    python benchmarks/lms_parsing_benchmark.py --iterations 200
+"""
+import argparse, json, re, sys, time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+FIXTURES = ROOT / "benchmarks" / "fixtures" / "lms"
+sys.path.insert(0, str(ROOT / "backend"))
+
+import lms_parsing
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="LMS HTML parsing micro-benchmark")
+    parser.add_argument("--iterations", type=int, default=100, help="parses of each fixture per implementation")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    return parser.parse_args()
+
+def bs4_subjects(classes_html):
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(classes_html, 'lxml')
+    subjects = []
+    for container in soup.find_all('div', class_=lambda c: c and 'subjectcontainer' in [cls.strip(';') for cls in c.split()]):
+        subject_name_tag = container.find('h4', class_='cfullname')
+        launch_link_tag = container.find('a', class_='launchbutton')
+        attendance_total = container.find('div', class_='subcontent-container').find('span', class_='attendance-total')
+        if subject_name_tag and launch_link_tag:
+            subjects.append({
+                "subject_name": subject_name_tag.text.strip(),
+                "url": launch_link_tag.get('href').strip(),
+                "attendance": attendance_total.text.strip() if attendance_total else "---"
+            })
+    return subjects
+
+def bs4_logout_link(dashboard_html):
+    from bs4 import BeautifulSoup
+    logout_link = BeautifulSoup(dashboard_html, 'lxml').find('a', href=lambda href: href and 'logout.php?sesskey=' in href)
+    return logout_link['href'] if logout_link else ""
+
+def bs4_activities(subject_html):
+    from bs4 import BeautifulSoup
+    return [
+        (f.find("a")["href"], str(f.find("span", class_="instancename").contents[0]))
+        for f in BeautifulSoup(subject_html, "lxml").find_all('div', class_="activityinstance")
+    ]
+
+def bs4_resource_link(resource_html):
+    match = re.search(r'["\'](https?://[^\s"]+\.(?:pdf|docx|pptx))', resource_html)
+    return match.group(1) if match else None
+
+CASES = {
+    "classes": (
+        bs4_subjects,
+        lambda page: [subject._asdict() for subject in lms_parsing.parse_subjects(page)]
+    ),
+    "dashboard": (bs4_logout_link, lms_parsing.parse_logout_link),
+    "course": (bs4_activities, lambda page: [tuple(a) for a in lms_parsing.parse_activities(page)]),
+    "resource": (bs4_resource_link, lms_parsing.parse_resource_link),
+}
+
+def measure(func, page, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func(page)
+    return (time.perf_counter() - start) / iterations
+
+def run(args):
+    report = {}
+    for name, (baseline, current) in CASES.items():
+        page = (FIXTURES / f"{name}.html").read_text()
+        if baseline(page) != current(page):
+            raise SystemExit(f"{name}: lms_parsing output differs from the BeautifulSoup baseline")
+        bs4_seconds = measure(baseline, page, args.iterations)
+        lxml_seconds = measure(current, page, args.iterations)
+        report[name] = {
+            "bytes": len(page),
+            "bs4_ms": bs4_seconds * 1000,
+            "lxml_ms": lxml_seconds * 1000,
+            "speedup": bs4_seconds / lxml_seconds if lxml_seconds else 0.0
+        }
+    return report
+
+def main():
+    args = parse_args()
+    report = run(args)
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    print(f"{'page':<12}{'bytes':>9}{'bs4 ms':>10}{'lxml ms':>10}{'speedup':>9}")
+    for name, stats in report.items():
+        print(f"{name:<12}{stats['bytes']:>9}{stats['bs4_ms']:>10.2f}{stats['lxml_ms']:>10.2f}{stats['speedup']:>8.1f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,244 @@
+"""Offline benchmark for the /query pipeline.
+
+Drives main.app in-process through the ASGI transport with a stub Gemini client, an in-memory Qdrant
+collection seeded from temp/answers.txt and a hashing embedder, so it runs with no network access.
+
+    python benchmarks/query_benchmark.py --requests 50 --concurrency 8 --llm-latency 0.3
+"""
+import argparse, asyncio, hashlib, json, logging, math, os, random, re, sys, tempfile, time
+from collections import defaultdict
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+BACKEND = ROOT / "backend"
+TEMP = ROOT / "temp"
+
+STAGES = ("cache_check", "sub_query", "retrieval", "synthesis", "cache_write")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Offline latency benchmark for the /query pipeline")
+    parser.add_argument("--requests", type=int, default=40, help="number of /query requests to send")
+    parser.add_argument("--concurrency", type=int, default=4, help="requests in flight at once")
+    parser.add_argument("--questions-per-request", type=int, default=5)
+    parser.add_argument("--repeat-ratio", type=float, default=0.3,
+                        help="fraction of questions drawn from already asked ones, to exercise the caches")
+    parser.add_argument("--llm-latency", type=float, default=0.2, help="mean stub LLM latency in seconds")
+    parser.add_argument("--llm-jitter", type=float, default=0.5, help="relative +/- jitter on LLM latency")
+    parser.add_argument("--llm-rate-limit", type=float, default=None,
+                        help="override LLM_RATE_LIMIT (calls/s) for the backend's LLM scheduler, 0 disables it")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    parser.add_argument("--max-p95", type=float, default=None,
+                        help="exit non-zero when p95 request latency (seconds) exceeds this")
+    return parser.parse_args()
+
+def install_offline_stand_ins(args):
+    """Replaces Gemini, Qdrant and FastEmbed before the backend imports them."""
+    os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{tempfile.mkdtemp()}/benchmark_cache.db"
+    os.environ.setdefault("GOOGLE_API_KEY", "offline-benchmark")
+    if args.llm_rate_limit is not None:
+        os.environ["LLM_RATE_LIMIT"] = str(args.llm_rate_limit)
+
+    import qdrant_client
+    import langchain_google_genai
+    import langchain_community.embeddings.fastembed as fastembed_module
+    from langchain_core.embeddings import Embeddings
+
+    qdrant = qdrant_client.QdrantClient(location=":memory:")
+    qdrant_client.QdrantClient = lambda *a, **k: qdrant
+
+    class HashingEmbeddings(Embeddings):
+        def __init__(self, *a, **k):
+            pass
+
+        def embed_query(self, text):
+            vector = [0.0] * 384
+            for word in re.findall(r"\w+", text.lower()):
+                vector[int(hashlib.md5(word.encode()).hexdigest(), 16) % 384] += 1.0
+            norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+            return [v / norm for v in vector]
+
+        def embed_documents(self, texts):
+            return [self.embed_query(t) for t in texts]
+
+    class StubMessage:
+        def __init__(self, content):
+            self.content = content
+
+    class StubLLM:
+        def __init__(self, *a, **k):
+            pass
+
+        def with_config(self, *a, **k):
+            return self
+
+        async def ainvoke(self, prompt):
+            await asyncio.sleep(max(0.0, args.llm_latency * random.uniform(1 - args.llm_jitter, 1 + args.llm_jitter)))
+            if "Questions:" in prompt or "User Questions:" in prompt:
+                block = prompt.split("Questions:")[1].split("<|eot_id|>")[0]
+                count = len(re.findall(r"^\s*\d+\.", block, re.M))
+                if "query generation" in prompt:
+                    return StubMessage(json.dumps({str(i+1): ["stub query one", "stub query two"] for i in range(count)}))
+                return StubMessage(json.dumps({str(i+1): "Stub answer." for i in range(count)}))
+            if "query generation" in prompt:
+                return StubMessage("grace period, waiting period, policy coverage")
+            return StubMessage("Stub answer.")
+
+        async def astream(self, prompt):
+            yield await self.ainvoke(prompt)
+
+    langchain_google_genai.ChatGoogleGenerativeAI = StubLLM
+    fastembed_module.FastEmbedEmbeddings = HashingEmbeddings
+    sys.path.insert(0, str(BACKEND))
+
+def load_workload():
+    questions = json.loads((TEMP / "questions.json").read_text())["questions"]
+    answers_text = (TEMP / "answers.txt").read_text()
+    corpus = re.findall(r'"((?:[^"\\]|\\.)+?)"\s*[,\]]', answers_text.split('{"answers":[', 1)[-1], re.S)
+    return questions, corpus or questions
+
+class StageTimer:
+    def __init__(self):
+        self.timings = defaultdict(list)
+        self.cache_hits = 0
+        self.cache_lookups = 0
+
+    def count_cache_hits(self, main):
+        check_cache, check_semantic_cache = main.checkCache, main.checkSemanticCache
+
+        async def counted_check_cache(questions):
+            answers, unanswered = await check_cache(questions)
+            self.cache_lookups += len(questions)
+            self.cache_hits += sum(1 for answer in answers if answer is not None)
+            return answers, unanswered
+
+        async def counted_check_semantic_cache(*a, **k):
+            hits = await check_semantic_cache(*a, **k)
+            self.cache_hits += hits
+            return hits
+
+        main.checkCache = counted_check_cache
+        main.checkSemanticCache = counted_check_semantic_cache
+
+    def wrap(self, module, name, stage):
+        original = getattr(module, name)
+
+        async def timed(*a, **k):
+            start = time.perf_counter()
+            try:
+                return await original(*a, **k)
+            finally:
+                self.timings[stage].append(time.perf_counter() - start)
+
+        setattr(module, name, timed)
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(p / 100 * len(ordered)) - 1))]
+
+def summarize(values):
+    return {
+        "count": len(values),
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "mean": sum(values) / len(values) if values else 0.0
+    }
+
+async def run(args):
+    import httpx
+    import cache, main, response_generation
+    from llm_scheduler import LLM_SCHEDULER
+    from langchain.docstore.document import Document
+
+    questions, corpus = load_workload()
+    await cache.init_db()
+    await response_generation.QDRANT_INSTANCE.aadd_documents(
+        [Document(page_content=text, metadata={"subject": "benchmark", "content_hash": cache.hash_text(text)})
+         for text in corpus]
+    )
+
+    logging.getLogger().setLevel(logging.WARNING)
+    timer = StageTimer()
+    timer.count_cache_hits(main)
+    timer.wrap(main, "checkCache", "cache_check")
+    timer.wrap(response_generation, "generate_sub_queries", "sub_query")
+    timer.wrap(response_generation, "generate_sub_queries_batch", "sub_query")
+    timer.wrap(response_generation, "retrieve_context_chunks", "retrieval")
+    timer.wrap(response_generation, "answer_question_with_context", "synthesis")
+    timer.wrap(response_generation, "answer_questions_with_shared_context", "synthesis")
+    timer.wrap(response_generation, "store_answers", "cache_write")
+
+    asked = []
+    batches = []
+    for r in range(args.requests):
+        batch = []
+        for q in range(args.questions_per_request):
+            if asked and random.random() < args.repeat_ratio:
+                batch.append(random.choice(asked))
+            else:
+                # Suffix keeps unique questions distinct from the exact and semantic caches
+                batch.append(f"{random.choice(questions)} (variant {r}-{q})")
+            asked.append(batch[-1])
+        batches.append(batch)
+
+    latencies = []
+    errors = 0
+    limiter = asyncio.Semaphore(args.concurrency)
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=None) as client:
+        async def send(batch):
+            nonlocal errors
+            async with limiter:
+                start = time.perf_counter()
+                response = await client.post("/query", json={"questions": batch})
+                latencies.append(time.perf_counter() - start)
+                if response.status_code != 200:
+                    errors += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*[send(batch) for batch in batches])
+        elapsed = time.perf_counter() - started
+
+    return {
+        "requests": args.requests,
+        "questions": args.requests * args.questions_per_request,
+        "errors": errors,
+        "elapsed_seconds": elapsed,
+        "throughput_rps": args.requests / elapsed if elapsed else 0.0,
+        "throughput_qps": args.requests * args.questions_per_request / elapsed if elapsed else 0.0,
+        "cache_hit_rate": timer.cache_hits / timer.cache_lookups if timer.cache_lookups else 0.0,
+        "llm_scheduler": LLM_SCHEDULER.stats(),
+        "latency": summarize(latencies),
+        "stages": {stage: summarize(timer.timings[stage]) for stage in STAGES}
+    }
+
+def print_report(report):
+    print(f"requests: {report['requests']}  questions: {report['questions']}  errors: {report['errors']}")
+    print(f"elapsed: {report['elapsed_seconds']:.2f}s  throughput: {report['throughput_rps']:.2f} req/s, "
+          f"{report['throughput_qps']:.2f} questions/s  cache hit rate: {report['cache_hit_rate']:.1%}")
+    scheduler = report["llm_scheduler"]
+    print(f"llm calls: {scheduler['calls']}  avg scheduler wait: {scheduler['avg_wait_seconds']*1000:.1f}ms  "
+          f"max wait: {scheduler['max_wait_seconds']*1000:.1f}ms")
+    print(f"{'stage':<12}{'count':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'mean ms':>10}")
+    for name, stats in [("request", report["latency"]), *report["stages"].items()]:
+        print(f"{name:<12}{stats['count']:>7}{stats['p50']*1000:>10.1f}{stats['p95']*1000:>10.1f}"
+              f"{stats['p99']*1000:>10.1f}{stats['mean']*1000:>10.1f}")
+
+def main():
+    args = parse_args()
+    random.seed(args.seed)
+    install_offline_stand_ins(args)
+    report = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+    if args.max_p95 is not None and report["latency"]["p95"] > args.max_p95:
+        print(f"p95 latency {report['latency']['p95']:.3f}s exceeds --max-p95 {args.max_p95}s", file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
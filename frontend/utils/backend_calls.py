@@ -1,54 +1,111 @@
 import streamlit as st
-import logging, requests,time
+import logging, requests, json, time
 
 
 @st.dialog("Ingesting Data",dismissible=False,width="large")
 def ingestFiles(selected_files):
     if st.session_state.ingesting_data==True:
-        for f in selected_files:
-            upload_file(f)
+        jobs = upload_files(selected_files)
+        track_jobs(jobs)
         st.session_state.ingesting_data=False
         if st.button("Continue",disabled=st.session_state.ingesting_data):
             st.rerun(scope="app")
     else:
         st.rerun()
 
-def upload_file(file):
+def upload_files(files):
     s = requests.Session()
-    upload_endpoint="http://localhost:8000/upload"
+    upload_endpoint="http://localhost:8000/upload/batch"
     form_data = {
         "session_id": st.session_state.get("lms_session_id"),
-        "subject": file["subject"],
-        "file_name": file["file_name"],
-        "file_link": file["file_link"],
+        "files": [
+            {
+                "subject": file["subject"],
+                "file_name": file["file_name"],
+                "file_link": file["file_link"],
+            }
+            for file in files
+        ]
      }
-    with st.status(f"Uploading {file["file_name"]}") as status:
-        logging.info(f"Uploading {file["file_name"]}, {file["file_link"]}")
+    logging.info(f"Queueing {len(files)} files for ingestion")
+    try:
         response = s.post(upload_endpoint,json=form_data)
-        try:
-            data = response.json()
-            status.update(
-                label=f"{file["file_name"]} : {data.get("status","An error occured")}"
-            )
-        except:
-            status.update(label="An error occured on the backend")
+        return list(zip(files, response.json().get("jobs", [])))
+    except:
+        logging.error("Failed to queue files for ingestion")
+        st.write("An error occured on the backend")
+        return []
+
+def track_jobs(jobs):
+    s = requests.Session()
+    statuses = {}
+    pending = {}
+    for file, job in jobs:
+        if job["job_id"] not in statuses:
+            statuses[job["job_id"]] = st.status(f"Queued {file['file_name']}")
+            pending[job["job_id"]] = file
+    while pending:
+        for job_id, file in list(pending.items()):
+            try:
+                response = s.get(f"http://localhost:8000/jobs/{job_id}")
+                data = response.json()
+            except:
+                statuses[job_id].update(label="An error occured on the backend", state="error")
+                del pending[job_id]
+                continue
+            # Job state lives in one backend worker and is trimmed over time, so a job can stop being found
+            if response.status_code == 404:
+                statuses[job_id].update(label=f"{file['file_name']} : job lost, check the documents list", state="error")
+                del pending[job_id]
+                continue
+            if response.status_code != 200:
+                statuses[job_id].update(label=f"{file['file_name']} : An error occured on the backend", state="error")
+                del pending[job_id]
+                continue
+            if data.get("status") in ("completed", "failed"):
+                statuses[job_id].update(
+                    label=f"{file['file_name']} : {data.get('result') or 'An error occured'}",
+                    state="complete" if data["status"] == "completed" else "error"
+                )
+                del pending[job_id]
+            else:
+                statuses[job_id].update(label=f"{file['file_name']} : {data.get('stage') or 'queued'}")
+        if pending:
+            time.sleep(1)
     
 def reqQuery(prompt):
     s=requests.Session()
-    query_endpoint="http://localhost:8000/query"
+    query_endpoint="http://localhost:8000/query/stream"
     questions = prompt.split("\n\n")
+    # Tokens from concurrently generated answers would interleave, so only a single question is token-streamed
+    stream_tokens = len(questions) == 1
     form_data = {
-        "questions": questions
+        "questions": questions,
+        "stream_tokens": stream_tokens
     }
     logging.info(f"Querying the backend for questions: {questions}")
-    response = s.post(query_endpoint,json=form_data)
     try:
-        data = response.json()
-        answers = data.get("answers")
-        for answer in answers:
-            for word in answer.split():
-                yield word + " "
-                time.sleep(0.07)
+        with s.post(query_endpoint,json=form_data,stream=True) as response:
+            response.raise_for_status()
+            streamed = set()
+            for line in response.iter_lines(decode_unicode=True):
+                if not line:
+                    continue
+                event = json.loads(line)
+                if "token" in event:
+                    streamed.add(event["index"])
+                    yield event["token"]
+                elif "error" in event:
+                    # Generation failed, possibly after some tokens were already shown
+                    prefix = f"**{event['index']+1}.** " if len(questions) > 1 else ""
+                    separator = "\n\n" if event["index"] in streamed else ""
+                    yield f"{separator}{prefix}⚠️ {event['error']}\n\n"
+                elif event["index"] in streamed:
+                    continue
+                elif len(questions) > 1:
+                    yield f"**{event['index']+1}.** {event['answer']}\n\n"
+                else:
+                    yield event["answer"]
     except:
         logging.error("Querying failed")
         
@@ -105,14 +162,17 @@ def logoutOfLms():
     except requests.exceptions.RequestException as e:
         logging.error(f"An error occurred while logging out: {e}")
 
+# Keyed on the session too, so one user's listing is never shown to another; the backend holds the shared copy.
+# Bumping version re-fetches one subject without clearing anyone else's entries; _refresh is left out of the key.
 @st.cache_data
-def fetchFiles(subject:str,subject_url: str):
+def fetchFiles(subject:str,subject_url: str,session_id: str,version: int = 0,_refresh: bool = False):
     s = requests.Session()
     fetch_endpoint = "http://localhost:8000/fetch"
     form_data = {
-        "session_id": st.session_state.get("lms_session_id"),
+        "session_id": session_id,
         "subject": subject,
-        "url": subject_url
+        "url": subject_url,
+        "refresh": _refresh
     }
     try:
         logging.info("Fetching files")
@@ -100,9 +100,13 @@ def selectFiles():
                     )
                     st.write("\n")
                     st.write("\n")
+                    refresh = st.button("Refresh",disabled=st.session_state.ingesting_data)
+                    versions = st.session_state.setdefault("file_list_versions",{})
+                    if refresh:
+                        versions[selected_subject] = versions.get(selected_subject,0) + 1
                     gap,left,right = st.columns([0.4,0.3,0.3])
                     try:
-                        files = fetchFiles(selected_subject,subject["url"],)
+                        files = fetchFiles(selected_subject,subject["url"],st.session_state.get("lms_session_id"),versions.get(selected_subject,0),refresh)
                         for i,f in enumerate(files):
                             lenght_of_column = math.ceil(len(files)/2)
                             file_name=f["file_name"]
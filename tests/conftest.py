@@ -0,0 +1,37 @@
+import asyncio, os, sys, tempfile
+from pathlib import Path
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+FIXTURES = ROOT / "benchmarks" / "fixtures" / "lms"
+sys.path.insert(0, str(ROOT / "backend"))
+
+# cache.py builds its engine at import time, so the tests get a throwaway database before any backend module loads
+os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{Path(tempfile.mkdtemp()) / 'test.db'}"
+
+@pytest.fixture
+def run():
+    """Runs a coroutine on a fresh event loop, closing pooled connections before that loop goes away."""
+    import cache
+
+    def run(coroutine):
+        async def main():
+            try:
+                return await coroutine
+            finally:
+                await cache.engine.dispose()
+        return asyncio.run(main())
+    return run
+
+@pytest.fixture
+def db(run):
+    """An empty database and memory tier for each test."""
+    import cache
+
+    async def reset():
+        await cache.init_db()
+        async with cache.engine.begin() as conn:
+            for table in reversed(cache.Base.metadata.sorted_tables):
+                await conn.execute(table.delete())
+    run(reset())
+    cache.MEMORY_CACHE.invalidate()
@@ -0,0 +1,182 @@
+import pytest
+from sqlalchemy import event, update, delete
+import cache
+from cache import add_qa_entries, checkCache, get_answers, question_key, MemoryCache, CorpusGeneration, MEMORY_CACHE
+
+@pytest.fixture
+def statements():
+    """SQL statements executed against the cache database, to count round trips."""
+    executed = []
+    def record(conn, cursor, statement, *args):
+        executed.append(statement)
+    event.listen(cache.engine.sync_engine, "before_cursor_execute", record)
+    yield executed
+    event.remove(cache.engine.sync_engine, "before_cursor_execute", record)
+
+def selects(statements):
+    return [s for s in statements if s.lstrip().upper().startswith("SELECT") and "qa_entries" in s]
+
+def test_batches_larger_than_the_chunk_size_round_trip(db, run, statements, monkeypatch):
+    monkeypatch.setattr("cache.CACHE_BATCH_SIZE", 7)
+    pairs = [(f"question {i}", f"answer {i}") for i in range(7 * 2 + 3)]
+    assert run(add_qa_entries(pairs)) == len(pairs)
+    MEMORY_CACHE.invalidate()
+
+    statements.clear()
+    found = run(get_answers([question_key(q) for q, _ in pairs]))
+    assert {entry.question: entry.answer for entry in found.values()} == dict(pairs)
+    # One IN query per chunk rather than one per question
+    assert len(selects(statements)) == 3
+
+def test_lookups_skip_the_database_for_memory_hits(db, run, statements):
+    run(add_qa_entries([("cached?", "yes")]))
+    statements.clear()
+    found = run(get_answers([question_key("cached?")]))
+    assert found[question_key("cached?")].answer == "yes"
+    assert not selects(statements)
+
+def test_duplicate_and_unknown_questions(db, run):
+    assert run(add_qa_entries([("What is TCP?", "first"), ("what is tcp", "second")])) == 1
+    MEMORY_CACHE.invalidate()
+    key = question_key("What is TCP?")
+    found = run(get_answers([key, key, question_key("never asked")]))
+    assert list(found) == [key]
+    assert found[key].answer == "second"
+
+def test_upserts_replace_existing_answers_and_provenance(db, run):
+    run(add_qa_entries([("q", "old")], [{"content_hashes": ["a"], "subjects": ["S1"]}]))
+    run(add_qa_entries([("q", "new")], [{"content_hashes": ["b"], "subjects": ["S2"]}]))
+    MEMORY_CACHE.invalidate()
+    entry = run(get_answers([question_key("q")]))[question_key("q")]
+    assert (entry.answer, entry.content_hashes, entry.subjects) == ("new", '["b"]', '["S2"]')
+
+def test_check_cache_marks_answered_questions(db, run):
+    run(add_qa_entries([("known", "answer")]))
+    answers, unanswered = run(checkCache(["known", "unknown"]))
+    assert answers == ["answer", None]
+    assert unanswered == ["Cached", "unknown"]
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr("cache.time.monotonic", clock)
+    return clock
+
+def test_memory_cache_evicts_least_recently_used():
+    memory = MemoryCache(max_size=2, ttl=60)
+    memory.put("a", 1)
+    memory.put("b", 2)
+    assert memory.get("a") == 1
+    memory.put("c", 3)
+    assert memory.get("b") is None
+    assert memory.get("a") == 1
+    assert memory.get("c") == 3
+    assert memory.stats()["evictions"] == 1
+
+def test_memory_cache_expires_entries(clock):
+    memory = MemoryCache(max_size=10, ttl=5)
+    memory.put("a", 1)
+    clock.now += 4
+    assert memory.get("a") == 1
+    clock.now += 2
+    assert memory.get("a") is None
+    stats = memory.stats()
+    assert (stats["hits"], stats["misses"], stats["expirations"], stats["size"]) == (1, 1, 1, 0)
+
+def test_memory_cache_invalidates_selected_keys():
+    memory = MemoryCache(max_size=10, ttl=60)
+    for key in "abc":
+        memory.put(key, key)
+    memory.invalidate(["a", "missing"])
+    assert memory.get("a") is None and memory.get("b") == "b"
+    memory.invalidate()
+    assert memory.stats()["size"] == 0
+
+def test_memory_cache_with_no_capacity_stores_nothing():
+    memory = MemoryCache(max_size=0, ttl=60)
+    memory.put("a", 1)
+    assert memory.get("a") is None
+
+def test_memory_entries_expire_after_another_worker_ingests(db, run, clock, monkeypatch):
+    monkeypatch.setattr("cache.GENERATION_REFRESH_SECONDS", 5)
+    run(cache.bump_generation("S1"))
+    generation = run(cache.get_generation())
+    run(add_qa_entries([("q", "a")], [{"content_hashes": ["h"], "subjects": ["S1"]}], generation))
+    assert run(get_answers([question_key("q")]))
+
+    async def ingest_elsewhere():
+        # What bump_generation on another worker leaves behind: newer generations and the row gone, this memory tier untouched
+        async with cache.AsyncSessionLocal() as session:
+            await session.execute(update(CorpusGeneration).values(generation=generation + 1))
+            await session.execute(delete(cache.QAEntry))
+            await session.commit()
+    run(ingest_elsewhere())
+    # Served from memory until the generation snapshot is refreshed
+    assert run(get_answers([question_key("q")]))
+    clock.now += 5
+    assert not run(get_answers([question_key("q")]))
+    assert question_key("q") not in MEMORY_CACHE.entries
+
+@pytest.mark.parametrize("question, normalized", [
+    ("  What is   a Stack? ", "what is a stack"),
+    ("Define TCP!!", "define tcp"),
+    ("Explain C++.", "explain c++"),
+    ("what is 2+2", "what is 2+2"),
+])
+def test_normalize_question(question, normalized):
+    assert cache.normalize_question(question) == normalized
+
+@pytest.mark.parametrize("first, second", [("What is C++?", "What is C?"), ("2+2", "2-2"), ("e.g. TCP", "eg TCP")])
+def test_question_key_keeps_meaningful_punctuation(first, second):
+    assert question_key(first) != question_key(second)
+
+def test_question_key_ignores_case_and_spacing():
+    assert question_key("What is a stack?") == question_key("what  is a STACK")
+
+def provenance(*subjects):
+    return {"content_hashes": [f"hash of {subject}" for subject in subjects], "subjects": list(subjects)}
+
+def test_bump_generation_stamps_the_subject_with_the_global_generation(db, run):
+    assert run(cache.bump_generation("S1")) == 1
+    assert run(cache.bump_generation("S2")) == 2
+    assert run(cache.get_generations(["S1", "S2", "S3"])) == {"*": 2, "S1": 1, "S2": 2}
+
+def test_invalidation_drops_the_subject_and_contextless_answers(db, run, monkeypatch):
+    dropped = []
+    async def handler(question_hashes):
+        dropped.extend(question_hashes)
+    monkeypatch.setattr("cache.INVALIDATION_HANDLERS", [handler])
+    pairs = [("about s1", "a"), ("about s2", "b"), ("about both", "c"), ("no context", "d")]
+    run(add_qa_entries(pairs, [provenance("S1"), provenance("S2"), provenance("S1", "S2"), None]))
+
+    run(cache.bump_generation("S1"))
+    assert sorted(dropped) == sorted(question_key(q) for q in ("about s1", "about both", "no context"))
+    assert set(MEMORY_CACHE.entries) == {question_key("about s2")}
+    MEMORY_CACHE.invalidate()
+    assert list(run(get_answers([question_key(q) for q, _ in pairs]))) == [question_key("about s2")]
+
+def test_answers_generated_across_an_ingest_are_not_stored(db, run):
+    generation = run(cache.get_generation())
+    # S1 is re-ingested while the answers are being generated
+    run(cache.bump_generation("S1"))
+    pairs = [("about s1", "a"), ("about s2", "b"), ("no context", "c")]
+    stored = run(add_qa_entries(pairs, [provenance("S1"), provenance("S2"), None], generation))
+    assert stored == 1
+    assert set(MEMORY_CACHE.entries) == {question_key("about s2")}
+    MEMORY_CACHE.invalidate()
+    assert list(run(get_answers([question_key(q) for q, _ in pairs]))) == [question_key("about s2")]
+
+def test_answers_generated_after_the_ingest_are_stored(db, run):
+    run(cache.bump_generation("S1"))
+    generation = run(cache.get_generation())
+    pairs = [("about s1", "a"), ("no context", "b")]
+    assert run(add_qa_entries(pairs, [provenance("S1"), None], generation)) == 2
+    entry = run(get_answers([question_key("about s1")]))[question_key("about s1")]
+    assert entry.generation == generation
@@ -0,0 +1,24 @@
+import uuid
+from documents import source_key, chunk_point_id
+
+RESOURCE = "https://mydy.dypatil.edu/rait/pluginfile.php/98765/mod_resource/content/{}/Lecture%203%20notes.pdf"
+
+def test_source_key_ignores_revision_and_query():
+    assert source_key(RESOURCE.format(1)) == source_key(RESOURCE.format(7) + "?forcedownload=1")
+    assert source_key(RESOURCE.format(3)) == "https://mydy.dypatil.edu/rait/pluginfile.php/98765/mod_resource/content/Lecture%203%20notes.pdf"
+
+def test_source_key_keeps_other_links_intact():
+    link = "https://mydy.dypatil.edu/rait/pluginfile.php/1/doc1.pdf"
+    assert source_key(link) == link
+    assert source_key(RESOURCE.format(1)) != source_key(RESOURCE.format(1).replace("98765", "98766"))
+
+def test_chunk_point_id_is_a_stable_uuid():
+    point_id = chunk_point_id("key", "chunk")
+    assert point_id == chunk_point_id("key", "chunk")
+    assert str(uuid.UUID(point_id)) == point_id
+
+def test_chunk_point_id_depends_on_source_and_chunk():
+    ids = {chunk_point_id(key, chunk) for key in ("a", "b") for chunk in ("x", "y")}
+    assert len(ids) == 4
+    # The separator keeps ("ab", "c") and ("a", "bc") apart
+    assert chunk_point_id("ab", "c") != chunk_point_id("a", "bc")
@@ -0,0 +1,94 @@
+import asyncio, time
+import pytest
+from llm_scheduler import LLMScheduler, PRIORITY_ANSWER, PRIORITY_SUB_QUERY
+
+def scheduler(rate=0, burst=1, max_in_flight=16, max_retries=3, retry_budget=20):
+    return LLMScheduler(rate, burst, max_in_flight, max_retries, base_delay=0, retry_budget=retry_budget, retry_budget_ratio=0.1)
+
+class RateLimited(Exception):
+    code = 429
+
+def test_answers_are_dispatched_before_sub_queries():
+    llm = scheduler(max_in_flight=1)
+    order = []
+
+    async def main():
+        release = asyncio.Event()
+        async def call(name, wait=None):
+            if wait:
+                await wait.wait()
+            order.append(name)
+        blocker = asyncio.create_task(llm.run(PRIORITY_ANSWER, lambda: call("blocker", release)))
+        await asyncio.sleep(0)
+        queued = [
+            asyncio.create_task(llm.run(PRIORITY_SUB_QUERY, lambda: call("sub query"))),
+            asyncio.create_task(llm.run(PRIORITY_ANSWER, lambda: call("answer")))
+        ]
+        await asyncio.sleep(0)
+        assert llm.stats()["queue_depth"] == 2
+        release.set()
+        await asyncio.gather(blocker, *queued)
+
+    asyncio.run(main())
+    assert order == ["blocker", "answer", "sub query"]
+
+def test_token_bucket_spaces_calls_after_the_burst():
+    llm = scheduler(rate=20, burst=2)
+
+    async def main():
+        start = time.monotonic()
+        async def call():
+            return time.monotonic() - start
+        return await asyncio.gather(*[llm.run(PRIORITY_ANSWER, call) for _ in range(4)])
+
+    elapsed = asyncio.run(main())
+    assert elapsed[1] < 0.03
+    # Each call past the burst waits for one token at 20 per second
+    assert 0.04 <= elapsed[2] < 0.2
+    assert 0.09 <= elapsed[3] < 0.3
+
+def test_in_flight_cap():
+    llm = scheduler(max_in_flight=2)
+    peak = 0
+
+    async def main():
+        async def call():
+            nonlocal peak
+            peak = max(peak, llm.in_flight)
+            await asyncio.sleep(0.01)
+        await asyncio.gather(*[llm.run(PRIORITY_ANSWER, call) for _ in range(6)])
+
+    asyncio.run(main())
+    assert peak == 2
+    assert llm.in_flight == 0
+
+def test_retryable_failures_are_retried_within_the_budget():
+    llm = scheduler(retry_budget=2)
+    attempts = 0
+
+    async def call():
+        nonlocal attempts
+        attempts += 1
+        raise RateLimited("slow down")
+
+    with pytest.raises(RateLimited):
+        asyncio.run(llm.run(PRIORITY_ANSWER, call))
+    # The budget runs out before max_retries does
+    assert attempts == 3
+    assert llm.stats()["retries"] == 2
+
+def test_non_retryable_failures_and_vetoed_retries_raise_immediately():
+    llm = scheduler()
+    attempts = 0
+
+    async def call(error):
+        nonlocal attempts
+        attempts += 1
+        raise error
+
+    with pytest.raises(ValueError):
+        asyncio.run(llm.run(PRIORITY_ANSWER, lambda: call(ValueError("bad request"))))
+    with pytest.raises(RateLimited):
+        asyncio.run(llm.run(PRIORITY_ANSWER, lambda: call(RateLimited("slow down")), can_retry=lambda: False))
+    assert attempts == 2
+    assert llm.stats()["retries"] == 0
@@ -0,0 +1,35 @@
+import pytest
+from conftest import FIXTURES
+from lms_parsing import Activity, Subject, parse_activities, parse_logout_link, parse_resource_link, parse_subjects
+
+def fixture(name: str) -> str:
+    return (FIXTURES / f"{name}.html").read_text()
+
+def test_parse_subjects():
+    subjects = parse_subjects(fixture("classes"))
+    assert len(subjects) == 24
+    assert subjects[0] == Subject("Machine Learning 0", "https://mydy.dypatil.edu/rait/course/view.php?id=2000", "---")
+    assert subjects[1] == Subject("Computer Networks 1", "https://mydy.dypatil.edu/rait/course/view.php?id=2001", "78%")
+
+def test_parse_logout_link():
+    assert parse_logout_link(fixture("dashboard")) == "https://mydy.dypatil.edu/rait/login/logout.php?sesskey=Ab3dE5fG7h"
+
+def test_parse_logout_link_makes_relative_links_absolute():
+    page = '<a href="/rait/login/logout.php?sesskey=abc">Log out</a>'
+    assert parse_logout_link(page) == "https://mydy.dypatil.edu/rait/login/logout.php?sesskey=abc"
+
+def test_parse_activities_drops_the_activity_type():
+    activities = parse_activities(fixture("course"))
+    assert len(activities) == 150
+    assert activities[0] == Activity("https://mydy.dypatil.edu/rait/mod/resource/view.php?id=5000", "Lecture 0 notes - unit 1")
+    assert activities[-1] == Activity("https://mydy.dypatil.edu/rait/mod/resource/view.php?id=5149", "Lecture 149 notes - unit 25")
+
+def test_parse_resource_link():
+    assert parse_resource_link(fixture("resource")) == (
+        "https://mydy.dypatil.edu/rait/pluginfile.php/98765/mod_resource/content/1/Lecture%203%20notes.pdf"
+    )
+
+@pytest.mark.parametrize("parse", [parse_subjects, parse_activities])
+@pytest.mark.parametrize("page", ["", "   ", "<html><body>login</body></html>"])
+def test_pages_without_matches(parse, page):
+    assert parse(page) == []
@@ -0,0 +1,23 @@
+import pytest
+from metrics import Histogram, render_metrics
+
+def test_histogram_buckets_are_cumulative():
+    histogram = Histogram(buckets=(0.1, 1, 10))
+    for value in (0.05, 0.1, 0.5, 5, 50):
+        histogram.observe(value)
+    assert histogram.counts == [2, 3, 4]
+    assert histogram.count == 5
+    assert histogram.sum == pytest.approx(55.65)
+
+def test_render_metrics_writes_buckets_and_gauges(monkeypatch):
+    histogram = Histogram(buckets=(0.1, 1))
+    histogram.observe(0.5)
+    histogram.observe(2)
+    monkeypatch.setattr("metrics.STAGE_DURATIONS", {"retrieval": histogram})
+    lines = render_metrics({"rag_llm_in_flight": 3}).splitlines()
+    assert 'rag_stage_duration_seconds_bucket{stage="retrieval",le="0.1"} 0' in lines
+    assert 'rag_stage_duration_seconds_bucket{stage="retrieval",le="1"} 1' in lines
+    assert 'rag_stage_duration_seconds_bucket{stage="retrieval",le="+Inf"} 2' in lines
+    assert 'rag_stage_duration_seconds_sum{stage="retrieval"} 2.5' in lines
+    assert 'rag_stage_duration_seconds_count{stage="retrieval"} 2' in lines
+    assert lines[-2:] == ["# TYPE rag_llm_in_flight gauge", "rag_llm_in_flight 3"]
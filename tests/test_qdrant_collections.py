@@ -0,0 +1,60 @@
+from types import SimpleNamespace
+from qdrant_client.http.models import (
+    CollectionParamsDiff, Disabled, Distance, HnswConfigDiff, ScalarQuantization, ScalarQuantizationConfig, ScalarType, VectorParams
+)
+import qdrant_collections
+from qdrant_collections import migrate_collection, quantization_config
+
+class Client:
+    """Just the calls migrate_collection makes, since local Qdrant doesn't keep collection tuning."""
+
+    def __init__(self, config):
+        self.config = config
+        self.updates = []
+
+    def get_collection(self, collection_name):
+        return SimpleNamespace(config=self.config)
+
+    def update_collection(self, collection_name, **changes):
+        self.updates.append(changes)
+
+def tuned_config(**overrides):
+    config = {
+        "hnsw_config": HnswConfigDiff(m=qdrant_collections.QDRANT_HNSW_M, ef_construct=qdrant_collections.QDRANT_HNSW_EF_CONSTRUCT),
+        "params": SimpleNamespace(
+            vectors=VectorParams(size=384, distance=Distance.COSINE, on_disk=qdrant_collections.QDRANT_VECTORS_ON_DISK),
+            on_disk_payload=qdrant_collections.QDRANT_PAYLOAD_ON_DISK
+        ),
+        "quantization_config": quantization_config()
+    }
+    return SimpleNamespace(**{**config, **overrides})
+
+def test_tuned_collection_is_left_alone():
+    client = Client(tuned_config())
+    migrate_collection(client, "LMS")
+    assert client.updates == []
+
+def test_payload_storage_is_migrated():
+    config = tuned_config()
+    config.params.on_disk_payload = not qdrant_collections.QDRANT_PAYLOAD_ON_DISK
+    client = Client(config)
+    migrate_collection(client, "LMS")
+    assert client.updates == [{"collection_params": CollectionParamsDiff(on_disk_payload=qdrant_collections.QDRANT_PAYLOAD_ON_DISK)}]
+
+def test_changed_quantile_is_applied():
+    stale = ScalarQuantization(scalar=ScalarQuantizationConfig(type=ScalarType.INT8, quantile=0.9, always_ram=True))
+    client = Client(tuned_config(quantization_config=stale))
+    migrate_collection(client, "LMS")
+    assert client.updates == [{"quantization_config": quantization_config()}]
+
+def test_quantization_is_dropped_when_disabled(monkeypatch):
+    client = Client(tuned_config())
+    monkeypatch.setattr("qdrant_collections.QDRANT_QUANTIZATION", False)
+    migrate_collection(client, "LMS")
+    assert client.updates == [{"quantization_config": Disabled.DISABLED}]
+
+def test_hnsw_changes_are_applied(monkeypatch):
+    client = Client(tuned_config())
+    monkeypatch.setattr("qdrant_collections.QDRANT_HNSW_M", 32)
+    migrate_collection(client, "LMS")
+    assert client.updates == [{"hnsw_config": HnswConfigDiff(m=32, ef_construct=qdrant_collections.QDRANT_HNSW_EF_CONSTRUCT)}]